@@ -0,0 +1,149 @@
+import os
+from datetime import date
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from loguru import logger
+from pandas import DataFrame
+
+from main import compact_readings
+
+# Readings are partitioned by meter and year, e.g. MPRN=01234567890/year=2024,
+# so a query of one meter or one month only opens the files of its partitions.
+# The MPRN is a string, as it has leading zeros.
+partitioning = ds.partitioning(
+    pa.schema([("MPRN", pa.string()), ("year", pa.int16())]), flavor="hive"
+)
+
+schema = pa.schema(
+    [
+        ("Meter Serial Number", pa.string()),
+        ("Read Type", pa.dictionary(pa.int32(), pa.string())),
+        ("day", pa.date32()),
+        ("Read Value", pa.float64()),
+        ("MPRN", pa.string()),
+        ("year", pa.int16()),
+    ]
+)
+
+reading_columns = ["MPRN", "year", "Meter Serial Number", "Read Type", "day"]
+
+
+def open_archive(path: str) -> ds.Dataset:
+    return ds.dataset(path, schema=schema, format="parquet", partitioning=partitioning)
+
+
+def archive_table(data: DataFrame) -> pa.Table:
+    """The readings of one meter, in the HDF layout or compact, as archive rows"""
+    data = compact_readings(data)
+    days = pa.array(data["day"].to_numpy(), pa.int32()).cast(pa.date32())
+    return pa.table(
+        {
+            "Meter Serial Number": pa.repeat(
+                data.attrs["Meter Serial Number"], len(data)
+            ).cast(pa.string()),
+            "Read Type": pa.DictionaryArray.from_pandas(data["Read Type"]),
+            "day": days,
+            "Read Value": pa.array(data["Read Value"], pa.float64(), from_pandas=True),
+            "MPRN": pa.repeat(data.attrs["MPRN"], len(data)).cast(pa.string()),
+            "year": pc.year(days).cast(pa.int16()),
+        },
+        schema=schema,
+    )
+
+
+def append_archive(path: str, data: DataFrame) -> int:
+    """
+    Merge the readings of one meter in to the Parquet archive at `path`.
+    The meter's partitions for the years of the readings are read, merged
+    with them by the maximum value rule, one row per Read Type and day, and
+    rewritten. Other partitions are not touched.
+
+    :return: the number of readings in the rewritten partitions
+    """
+    new = archive_table(data)
+    if new.num_rows == 0:
+        return 0
+    mprn = data.attrs["MPRN"]
+    years = pc.unique(new["year"])
+
+    merged = new
+    if os.path.isdir(path):
+        existing = open_archive(path).to_table(
+            filter=(ds.field("MPRN") == mprn) & ds.field("year").isin(years)
+        )
+        merged = pa.concat_tables([existing, new]).unify_dictionaries()
+
+    # Sorted by day, so the statistics of each row group bound its dates
+    merged = (
+        merged.group_by(reading_columns)
+        .aggregate([("Read Value", "max")])
+        .rename_columns(reading_columns + ["Read Value"])
+        .sort_by("day")
+        .select(schema.names)
+        .cast(schema)
+    )
+    ds.write_dataset(
+        merged,
+        path,
+        format="parquet",
+        partitioning=partitioning,
+        existing_data_behavior="delete_matching",
+        basename_template="part-{i}.parquet",
+    )
+    logger.info(
+        f"Archived {merged.num_rows} readings of {mprn} for "
+        f"{', '.join(str(year) for year in sorted(years.to_pylist()))} in {path}"
+    )
+    return merged.num_rows
+
+
+def load_archive(
+    path: str,
+    mprn: str,
+    serial: str = None,
+    start: date = None,
+    end: date = None,
+) -> DataFrame:
+    """
+    Load the readings of one meter from the archive as compact readings (see
+    `main.compact_readings`), ready for `extract_import_entries` without
+    parsing any CSV. Only the files of the meter's partitions for the years
+    from `start` to `end` (inclusive) are opened, and the dates filter the
+    row groups within them.
+
+    :param serial: the Meter Serial Number, needed if the MPRN has had more
+        than one meter
+    """
+    condition = ds.field("MPRN") == mprn
+    if serial is not None:
+        condition &= ds.field("Meter Serial Number") == serial
+    if start is not None:
+        condition &= (ds.field("year") >= start.year) & (ds.field("day") >= start)
+    if end is not None:
+        condition &= (ds.field("year") <= end.year) & (ds.field("day") <= end)
+
+    table = open_archive(path).to_table(
+        columns=["Meter Serial Number", "Read Type", "day", "Read Value"],
+        filter=condition,
+    )
+    if table.num_rows == 0:
+        raise ValueError(f"No readings of {mprn} in {path}")
+
+    serials = pc.unique(table["Meter Serial Number"]).to_pylist()
+    assert len(serials) == 1, "More than one Meter Serial Number in the data"
+
+    readings = DataFrame(
+        {
+            "Read Value": table["Read Value"].to_numpy(),
+            "Read Type": pd.Categorical(
+                table["Read Type"].cast(pa.string()).to_numpy()
+            ),
+            "day": table["day"].cast(pa.int32()).to_numpy(),
+        }
+    )
+    readings.attrs["MPRN"] = mprn
+    readings.attrs["Meter Serial Number"] = serials[0]
+    return readings
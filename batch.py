@@ -0,0 +1,292 @@
+import argparse
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from loguru import logger
+from pandas import DataFrame
+
+from export import backends
+from main import (
+    DEFAULT_MAX_MEMORY_MB,
+    build_sheets,
+    compact_readings,
+    concatenate_files,
+    file_date,
+    hdf_filename,
+    output_filename,
+    window_start,
+    write_workbook,
+)
+from validate import check_readings
+
+SUMMARY_FILE = "batch_summary.csv"
+summary_columns = ["files", "rows", "month_days", "anomalies", "outfile", "error"]
+
+
+def find_files(inputs: list[str]) -> list[str]:
+    """
+    Expand directories and glob patterns in to a sorted list of CSV files.
+    Plain file paths are passed through as they are.
+    """
+    found = set()
+    for path in inputs:
+        if os.path.isdir(path):
+            found.update(glob.glob(os.path.join(path, "*.csv")))
+        elif glob.has_magic(path):
+            found.update(glob.glob(path))
+        else:
+            found.add(path)
+    return sorted(found)
+
+
+def peek_meter(file_path: str) -> tuple[str, str]:
+    """
+    Read the MPRN and Meter Serial Number from the first row of a HDF file,
+    without parsing the rest of it.
+    """
+    with open(file_path, newline="") as f:
+        row = next(csv.DictReader(f), None)
+    if row is None:
+        raise ValueError(f"No readings in {file_path}")
+    return row["MPRN"], row["Meter Serial Number"]
+
+
+def is_interval_file(file_path: str) -> bool:
+    """Whether the first row of a HDF file is a 30 minute interval reading"""
+    with open(file_path, newline="") as f:
+        row = next(csv.DictReader(f), None)
+    # Short rows have None for the missing fields
+    return row is not None and " Interval " in (row.get("Read Type") or "")
+
+
+def group_by_meter(files: list[str]) -> dict[tuple[str, str], list[str]]:
+    """
+    Group files by (MPRN, Meter Serial Number). The files for each meter are
+    ordered oldest download first, so later files correct earlier ones.
+    Interval files of a meter with Daily files are left out, as they can not
+    be combined (see `main.concatenate_files`).
+    """
+    meters = {}
+    for file in files:
+        try:
+            mprn, serial = peek_meter(file)
+        except Exception as e:
+            logger.error(f"Skipping {file}: {e}")
+            continue
+
+        match = hdf_filename.match(os.path.basename(file))
+        if match is not None and match.group("mprn") != mprn:
+            logger.warning(f"{file} contains MPRN {mprn}, not {match.group('mprn')}")
+
+        meters.setdefault((mprn, serial), []).append(file)
+
+    for key, files in meters.items():
+        intervals = [f for f in files if is_interval_file(f)]
+        if intervals and len(intervals) < len(files):
+            logger.warning(f"Leaving out the interval files of {key}: {intervals}")
+            files[:] = [f for f in files if f not in intervals]
+        files.sort(key=lambda f: (file_date(f) or datetime.min, f))
+
+    return meters
+
+
+def process_meter(
+    files: list[str],
+    days: int,
+    output_dir: str = ".",
+    read_options: dict = None,
+    backend: str = "openpyxl",
+    validate: bool = False,
+    fail_fast: bool = False,
+) -> dict:
+    """
+    Run the extract, diff and monthly pipeline for the files of one meter and
+    write its workbook. Errors are logged and reported in the summary rather
+    than raised, so that one bad meter does not stop the batch.
+
+    :param read_options: keyword arguments for `concatenate_files`
+    :param backend: the output backend (see `export.write_sheets`)
+    :param validate: check the readings, counting the anomalies and writing
+        them next to the workbook (see `validate.check_readings`)
+    :param fail_fast: with `validate`, fail the meter if there are errors
+    """
+    summary = {
+        "files": len(files),
+        "rows": 0,
+        "month_days": 0,
+        "anomalies": None,
+        "outfile": None,
+        "error": None,
+    }
+    try:
+        data = concatenate_files(files, **(read_options or {}))
+        summary["rows"] = data.shape[0]
+
+        if validate:
+            data = compact_readings(data)
+            report_file = os.path.join(
+                output_dir,
+                output_filename(
+                    data.attrs["MPRN"], data.attrs["Meter Serial Number"], days
+                ).replace("_data.xlsx", "_anomalies.csv"),
+            )
+            report = check_readings(data, fail_fast, report_file)
+            summary["anomalies"] = len(report)
+
+        daily, monthly = build_sheets(data, days)
+        summary["MPRN"] = daily.attrs["MPRN"]
+        summary["Meter Serial Number"] = daily.attrs["Meter Serial Number"]
+        summary["month_days"] = daily.shape[0]
+
+        outfile = os.path.join(
+            output_dir,
+            output_filename(summary["MPRN"], summary["Meter Serial Number"], days),
+        )
+        summary["outfile"] = write_workbook(daily, monthly, outfile, backend)[0]
+    except Exception as e:
+        logger.error(f"Failed to process {files}: {e}")
+        summary["error"] = str(e)
+
+    return summary
+
+
+def run_batch(
+    inputs: list[str],
+    days: int,
+    workers: int | None = None,
+    output_dir: str = ".",
+    read_options: dict = None,
+    backend: str = "openpyxl",
+    validate: bool = False,
+    fail_fast: bool = False,
+) -> DataFrame:
+    """
+    Process the HDF files of many meters in one run, one workbook per meter.
+    Meters are processed across a pool of `workers` processes (default: one
+    per CPU), or in this process if `workers` is 1. The files are read with
+    `concatenate_files`, given `read_options` as keyword arguments. With
+    `validate` the readings of each meter are checked, and with `fail_fast`
+    meters with errors fail rather than being written.
+
+    A summary of every meter is written to `batch_summary.csv` in `output_dir`
+    and returned.
+    """
+    files = find_files(inputs)
+    meters = group_by_meter(files)
+    logger.info(f"Batch started. {len(files)} files for {len(meters)} meters...")
+    if not meters:
+        logger.warning(f"No HDF files found in {', '.join(inputs)}")
+
+    os.makedirs(output_dir, exist_ok=True)
+    args = [
+        (meter_files, days, output_dir, read_options, backend, validate, fail_fast)
+        for meter_files in meters.values()
+    ]
+
+    if workers == 1 or not args:
+        results = [process_meter(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(process_meter, *zip(*args)))
+
+    index = pd.MultiIndex.from_arrays(
+        [[mprn for mprn, _ in meters], [serial for _, serial in meters]],
+        names=["MPRN", "Meter Serial Number"],
+    )
+    summary = DataFrame(results, index=index, columns=summary_columns)
+
+    summary_file = os.path.join(output_dir, SUMMARY_FILE)
+    summary.to_csv(summary_file)
+
+    failed = summary["error"].notna().sum()
+    logger.info(
+        f"Batch finished. {len(summary) - failed} meters written, {failed} failed. "
+        f"Summary in {summary_file}"
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Process the HDF files of many meters, one spreadsheet per meter."
+    )
+    parser.add_argument("days", type=int, help="Number of days to consider", default=7)
+    parser.add_argument(
+        "inputs",
+        type=str,
+        nargs="+",
+        help="HDF CSV files, directories or glob patterns",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--output-dir", type=str, default=".", help="Directory for the spreadsheets"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the files in chunks, keeping only the maximum value per day",
+    )
+    parser.add_argument(
+        "--max-memory-mb",
+        type=float,
+        default=DEFAULT_MAX_MEMORY_MB,
+        help="Memory ceiling in MB for buffered chunks when streaming",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache parsed files in, for faster repeat runs",
+    )
+    parser.add_argument(
+        "--max-cache-mb",
+        type=float,
+        default=None,
+        help="Size limit in MB of the cache directory (default 512)",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(backends),
+        default="openpyxl",
+        help="How to write the Daily and Monthly sheets",
+    )
+
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Check each meter's readings, writing any anomalies to a CSV report",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="With --validate, fail meters whose readings have errors",
+    )
+
+    args = parser.parse_args()
+
+    run_batch(
+        args.inputs,
+        args.days,
+        workers=args.workers,
+        output_dir=args.output_dir,
+        read_options={
+            "stream": args.stream,
+            "max_memory_mb": args.max_memory_mb,
+            "compact": not args.stream,
+            "cache_dir": args.cache_dir,
+            "max_cache_mb": args.max_cache_mb,
+            "since": window_start(args.days),
+        },
+        backend=args.backend,
+        validate=args.validate,
+        fail_fast=args.fail_fast,
+    )
@@ -0,0 +1,437 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from pandas import DataFrame
+
+from batch import group_by_meter
+from metrics import log_metrics, stage
+from main import (
+    build_sheets,
+    compact_readings,
+    concatenate_files,
+    dtype_spec,
+    extract_import_entries,
+    hdf_date_format,
+    output_filename,
+    parse_read_dates,
+    read_csv,
+    write_workbook,
+)
+
+IMPORT = "24 Hr Active Import Register (kWh)"
+EXPORT = "24 Hr Active Export Register (kWh)"
+NIGHT = "Night Import Register (kWh)"
+PEAK = "Day Peak Import Register (kWh)"
+DAY = "Day Off-Peak Import Register (kWh)"
+
+fixture_files = [
+    "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+    "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+    "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+]
+
+
+def best_of(fn, repeat: int = 3) -> float:
+    """The fastest wall time in seconds of `repeat` calls of `fn`"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_date_parsing(scale: int = 1000, repeat: int = 3) -> dict:
+    """
+    Compare the inferred date parsing and strftime month-day of the original
+    `extract_import_entries` with `parse_read_dates` and integer month, day
+    and year columns, on the test fixtures' dates repeated `scale` times.
+    """
+    fixture_dates = concatenate_files(fixture_files)["Read Date and End Time"]
+    dates = pd.Series(
+        fixture_dates.to_numpy().repeat(scale), name="Read Date and End Time"
+    )
+
+    def inferred():
+        parsed = pd.to_datetime(dates, dayfirst=True)
+        return parsed.dt.strftime("%m-%d"), parsed.dt.year
+
+    def fixed_format():
+        parsed = parse_read_dates(dates).dt
+        return parsed.month * 100 + parsed.day, parsed.year
+
+    result = {
+        "rows": len(dates),
+        "inferred_s": best_of(inferred, repeat),
+        "fixed_format_s": best_of(fixed_format, repeat),
+    }
+    result["speedup"] = result["inferred_s"] / result["fixed_format_s"]
+    return result
+
+
+def bench_reading_memory(scale: int = 1000) -> dict:
+    """
+    Compare the bytes per row of the concatenated HDF layout and of the
+    compact reading representation, on the test fixtures repeated `scale`
+    times.
+    """
+    fixtures = concatenate_files(fixture_files)
+    data = pd.concat([fixtures] * scale, ignore_index=True)
+    compact = compact_readings(data)
+
+    result = {
+        "rows": data.shape[0],
+        "hdf_bytes_per_row": data.memory_usage(deep=True).sum() / data.shape[0],
+        "compact_bytes_per_row": compact.memory_usage(deep=True).sum()
+        / compact.shape[0],
+    }
+    result["reduction"] = result["hdf_bytes_per_row"] / result["compact_bytes_per_row"]
+    return result
+
+
+def bench_pivot(scale: int = 1000, repeat: int = 3) -> dict:
+    """
+    Compare the NumPy and pandas pivots of `extract_import_entries` on the
+    compact readings of the test fixtures repeated `scale` times.
+    """
+    fixtures = concatenate_files(fixture_files, compact=True)
+    data = pd.concat([fixtures] * scale, ignore_index=True)
+    data.attrs = fixtures.attrs
+
+    result = {
+        "rows": data.shape[0],
+        "pandas_s": best_of(
+            lambda: extract_import_entries(data, 10000, "pandas"), repeat
+        ),
+        "numpy_s": best_of(
+            lambda: extract_import_entries(data, 10000, "numpy"), repeat
+        ),
+    }
+    result["speedup"] = result["pandas_s"] / result["numpy_s"]
+    return result
+
+
+def bench_scanner(scale: int = 1000, repeat: int = 3) -> dict:
+    """
+    Compare `pd.read_csv` with `dtype_spec`, alone and compacted as
+    `concatenate_files` does, with `scanner.scan_csv`, on a file of the
+    DNP test fixture's rows repeated `scale` times.
+    """
+    from scanner import scan_csv
+
+    with open(fixture_files[0]) as f:
+        header, rows = f.read().split("\n", 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, os.path.basename(fixture_files[0]))
+        with open(path, "w") as f:
+            f.write(header + "\n" + rows * scale)
+
+        result = {
+            "rows": scan_csv(path).shape[0],
+            "read_csv_s": best_of(lambda: pd.read_csv(path, dtype=dtype_spec), repeat),
+            "read_csv_compact_s": best_of(
+                lambda: compact_readings(pd.read_csv(path, dtype=dtype_spec)), repeat
+            ),
+            "scan_s": best_of(lambda: scan_csv(path), repeat),
+        }
+    result["speedup"] = result["read_csv_compact_s"] / result["scan_s"]
+    return result
+
+
+def write_hdf_file(
+    path: str,
+    mprn: str,
+    serial: str,
+    labels: np.ndarray,
+    registers: dict[str, np.ndarray],
+    keep: np.ndarray,
+):
+    """
+    Write a HDF file with a row per day and register, newest day first, in the
+    order of `registers`. Only the readings where `keep` is True are written.
+    """
+    read_types = list(registers)
+    values = np.stack([registers[t] for t in read_types], axis=1).ravel()
+    DataFrame(
+        {
+            "MPRN": mprn,
+            "Meter Serial Number": serial,
+            "Read Value": values,
+            "Read Type": np.tile(read_types, len(labels)),
+            "Read Date and End Time": np.repeat(labels, len(read_types)),
+        }
+    )[keep.ravel()].to_csv(path, index=False, float_format="%.3f")
+
+
+def generate_hdf_files(
+    out_dir: str,
+    years: int = 2,
+    meters: int = 1,
+    gap_rate: float = 0.01,
+    new_days: int = 7,
+    overlap_days: int = 2,
+    end: datetime = datetime(2024, 12, 26),
+    seed: int = 0,
+) -> list[str]:
+    """
+    Generate synthetic ESB Networks style HDF files for `meters` meters, with
+    `years` years of daily readings up to the day before `end`.
+
+    Each meter gets a Day/Night/Peak file and two import/export files, like
+    the test fixtures: an older download missing the last `new_days` days,
+    and a newer one with those days plus `overlap_days` days that revise the
+    older file's import readings upwards. A `gap_rate` fraction of readings
+    is left out of each file at random.
+
+    :return: the files written
+    """
+    rng = np.random.default_rng(seed)
+    n_days = years * 365
+
+    # Readings are at 00:00 of each day, newest first as in HDF files
+    days = pd.date_range(end=end - timedelta(days=1), periods=n_days, freq="D")[::-1]
+    labels = days.strftime(hdf_date_format).to_numpy()
+
+    def download_name(kind: str, mprn: str, newest: datetime) -> str:
+        date = (newest + timedelta(days=1)).strftime("%d-%m-%Y")
+        return os.path.join(out_dir, f"HDF_{kind}_kWh_{mprn}_{date}.csv")
+
+    def kept(n: int, width: int) -> np.ndarray:
+        return rng.random((n, width)) >= gap_rate
+
+    files = []
+    for meter in range(meters):
+        mprn = f"{1234567890 + meter:011d}"
+        serial = f"{87654321 + meter:018d}"
+
+        # Cumulative registers from random daily use, reversed to newest first
+        def register(start: float, daily_use: np.ndarray) -> np.ndarray:
+            return (start + np.cumsum(daily_use))[::-1]
+
+        dnp = {
+            NIGHT: register(rng.uniform(1e3, 2e4), rng.gamma(4, 2.5, n_days)),
+            PEAK: register(rng.uniform(1e2, 2e3), rng.gamma(2, 1.0, n_days)),
+            DAY: register(rng.uniform(1e3, 2e4), rng.gamma(4, 3.0, n_days)),
+        }
+        exported = np.where(rng.random(n_days) < 0.3, rng.gamma(2, 3.0, n_days), 0)
+        daily = {
+            IMPORT: dnp[NIGHT] + dnp[PEAK] + dnp[DAY],
+            EXPORT: register(rng.uniform(0, 5e3), exported),
+        }
+
+        path = download_name("DailyDNP", mprn, days[0])
+        write_hdf_file(path, mprn, serial, labels, dnp, kept(n_days, 3))
+        files.append(path)
+
+        # The older download, with its last overlap days not yet revised
+        older = {t: v[new_days:].copy() for t, v in daily.items()}
+        older[IMPORT][:overlap_days] -= rng.uniform(1, 20, overlap_days)
+        path = download_name("Daily", mprn, days[new_days])
+        write_hdf_file(
+            path, mprn, serial, labels[new_days:], older, kept(n_days - new_days, 2)
+        )
+        files.append(path)
+
+        newer = {t: v[: new_days + overlap_days] for t, v in daily.items()}
+        path = download_name("Daily", mprn, days[0])
+        write_hdf_file(
+            path,
+            mprn,
+            serial,
+            labels[: new_days + overlap_days],
+            newer,
+            np.ones((new_days + overlap_days, 2), dtype=bool),
+        )
+        files.append(path)
+
+    return files
+
+
+def bench_pipeline(
+    files: list[str], days: int = 100_000, backend: str = "openpyxl", output_dir="."
+) -> dict[str, dict]:
+    """
+    Time each stage of the pipeline for every meter in `files`, as `main`
+    runs it. For each stage the total wall and CPU time, rows in, throughput
+    and the peak RSS of the process after the stage are reported.
+    """
+    metrics = {}
+
+    for meter_files in group_by_meter(files).values():
+        with stage(metrics, "read_csv") as record:
+            for file in meter_files:
+                record["rows"] += read_csv(file).shape[0]
+
+        with stage(metrics, "concatenate_files") as record:
+            data = concatenate_files(meter_files, compact=True)
+            record["rows"] += data.shape[0]
+
+        daily, monthly = build_sheets(data, days, metrics=metrics)
+
+        outfile = os.path.join(
+            output_dir,
+            output_filename(
+                daily.attrs["MPRN"], daily.attrs["Meter Serial Number"], days
+            ),
+        )
+        with stage(metrics, "export", daily.shape[0]):
+            write_workbook(daily, monthly, outfile, backend)
+
+    for record in metrics.values():
+        record["rows_per_s"] = (
+            record["rows"] / record["wall_s"] if record["wall_s"] else 0
+        )
+    return metrics
+
+
+def compare_to_baseline(
+    stages: dict[str, dict], baseline: dict[str, dict], tolerance: float = 0.2
+) -> list[str]:
+    """
+    The stages that are more than `tolerance` (a fraction) slower than in the
+    baseline, described for the log.
+    """
+    regressions = []
+    for name, record in stages.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["wall_s"]
+        if record["wall_s"] > before * (1 + tolerance):
+            regressions.append(
+                f"{name} took {record['wall_s']:.3f}s against {before:.3f}s in the baseline"
+            )
+    return regressions
+
+
+def run_micro(args):
+    result = bench_date_parsing(args.scale, args.repeat)
+    logger.info(
+        f"Date parsing of {result['rows']} rows: "
+        f"inferred {result['inferred_s']:.3f}s, "
+        f"fixed format {result['fixed_format_s']:.3f}s, "
+        f"speedup {result['speedup']:.1f}x"
+    )
+
+    result = bench_reading_memory(args.scale)
+    logger.info(
+        f"Memory of {result['rows']} rows: "
+        f"HDF layout {result['hdf_bytes_per_row']:.0f} bytes/row, "
+        f"compact {result['compact_bytes_per_row']:.0f} bytes/row, "
+        f"{result['reduction']:.1f}x smaller"
+    )
+
+    result = bench_pivot(args.scale, args.repeat)
+    logger.info(
+        f"Pivot of {result['rows']} rows: "
+        f"pandas {result['pandas_s']:.3f}s, "
+        f"numpy {result['numpy_s']:.3f}s, "
+        f"speedup {result['speedup']:.1f}x"
+    )
+
+    result = bench_scanner(args.scale, args.repeat)
+    logger.info(
+        f"Reading {result['rows']} rows: "
+        f"read_csv {result['read_csv_s']:.3f}s, "
+        f"compacted {result['read_csv_compact_s']:.3f}s, "
+        f"scanner {result['scan_s']:.3f}s, "
+        f"speedup {result['speedup']:.1f}x"
+    )
+
+
+def run_pipeline(args) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or tmp
+        files = generate_hdf_files(
+            data_dir, args.years, args.meters, args.gap_rate, seed=args.seed
+        )
+        logger.info(
+            f"Generated {len(files)} files for {args.meters} meters in {data_dir}"
+        )
+
+        stages = bench_pipeline(files, args.days, args.backend, tmp)
+
+    log_metrics(stages)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(stages, f, indent=2)
+        logger.info(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(stages, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the HDF processing.")
+    subparsers = parser.add_subparsers(dest="suite", required=True)
+
+    micro = subparsers.add_parser(
+        "micro", help="Compare implementations on the scaled up test fixtures"
+    )
+    micro.add_argument(
+        "--scale",
+        type=int,
+        default=1000,
+        help="Number of times to repeat the test fixtures",
+    )
+    micro.add_argument("--repeat", type=int, default=3, help="Runs per timing")
+
+    pipeline = subparsers.add_parser(
+        "pipeline", help="Time each stage of the pipeline on synthetic HDF files"
+    )
+    pipeline.add_argument("--years", type=int, default=2, help="Years of readings")
+    pipeline.add_argument("--meters", type=int, default=1, help="Number of meters")
+    pipeline.add_argument(
+        "--gap-rate", type=float, default=0.01, help="Fraction of readings left out"
+    )
+    pipeline.add_argument("--seed", type=int, default=0, help="Random seed")
+    pipeline.add_argument(
+        "--days", type=int, default=100_000, help="Number of days to consider"
+    )
+    pipeline.add_argument(
+        "--backend", default="openpyxl", help="Output backend for the export stage"
+    )
+    pipeline.add_argument(
+        "--data-dir",
+        default=None,
+        help="Keep the generated files in this directory",
+    )
+    pipeline.add_argument(
+        "--baseline",
+        default="benchmark_baseline.json",
+        help="Stage timings to compare against",
+    )
+    pipeline.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Save the timings as the new baseline",
+    )
+    pipeline.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction a stage may be slower than the baseline",
+    )
+
+    args = parser.parse_args()
+
+    if args.suite == "micro":
+        run_micro(args)
+    else:
+        sys.exit(run_pipeline(args))
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from pandas import DataFrame
+
+from main import parse_read_dates, read_csv
+
+DEFAULT_CACHE_MAX_MB = 512
+
+# Columns held as categorical codes, with their categories in meta.json
+categorical_columns = ["MPRN", "Meter Serial Number", "Read Type"]
+
+
+def content_hash(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_key(file_path: str) -> str:
+    """A key for the path, size and modification time of a file"""
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def cache_entry(cache_dir: str, file_path: str) -> str:
+    """
+    The cache entry directory for a file. The content hash is only computed
+    when the path, size or modification time of the file has not been seen.
+    """
+    key_file = os.path.join(cache_dir, "keys", file_key(file_path))
+    try:
+        with open(key_file) as f:
+            digest = f.read().strip()
+    except FileNotFoundError:
+        digest = content_hash(file_path)
+        os.makedirs(os.path.dirname(key_file), exist_ok=True)
+        with open(key_file, "w") as f:
+            f.write(digest)
+    return os.path.join(cache_dir, "entries", digest)
+
+
+def write_entry(entry: str, data: DataFrame):
+    """
+    Store a parsed HDF file as one .npy file per column. Written to a
+    temporary directory first so a partial entry is never read.
+    """
+    tmp = f"{entry}.{os.getpid()}.tmp"
+    os.makedirs(tmp, exist_ok=True)
+
+    meta = {"rows": data.shape[0], "columns": list(data.columns), "categories": {}}
+    for column in categorical_columns:
+        codes, categories = pd.factorize(data[column])
+        np.save(os.path.join(tmp, f"{column}.npy"), codes.astype(np.int32))
+        meta["categories"][column] = categories.tolist()
+
+    np.save(
+        os.path.join(tmp, "Read Value.npy"), data["Read Value"].to_numpy(dtype=float)
+    )
+    dates = parse_read_dates(data["Read Date and End Time"])
+    np.save(
+        os.path.join(tmp, "Read Date and End Time.npy"),
+        dates.to_numpy(dtype="datetime64[s]"),
+    )
+
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    try:
+        os.replace(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # Written by another process
+
+
+def read_entry(entry: str) -> DataFrame:
+    """Load a cache entry with its arrays memory mapped rather than read"""
+    with open(os.path.join(entry, "meta.json")) as f:
+        meta = json.load(f)
+
+    columns = {}
+    for column in meta["columns"]:
+        array = np.load(os.path.join(entry, f"{column}.npy"), mmap_mode="r")
+        if column in categorical_columns:
+            columns[column] = pd.Categorical.from_codes(
+                array, meta["categories"][column]
+            )
+        else:
+            columns[column] = array
+
+    # Mark the entry as recently used, for eviction
+    os.utime(os.path.join(entry, "meta.json"))
+
+    return DataFrame(columns, copy=False)
+
+
+def read_cached_csv(
+    file_path: str, cache_dir: str, max_cache_mb: float = DEFAULT_CACHE_MAX_MB
+) -> DataFrame:
+    """
+    Read a HDF file through a cache of parsed files in `cache_dir`.
+
+    The cached frame has categorical MPRN, Meter Serial Number and Read Type
+    columns, and "Read Date and End Time" already parsed to datetimes.
+    """
+    entry = cache_entry(cache_dir, file_path)
+    if os.path.exists(os.path.join(entry, "meta.json")):
+        logger.debug(f"Reading {file_path} from cache {entry}")
+        return read_entry(entry)
+
+    data = read_csv(file_path)
+    if data is None:
+        return None
+
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    write_entry(entry, data)
+    evict(cache_dir, max_cache_mb, keep=entry)
+    return read_entry(entry)
+
+
+def evict(cache_dir: str, max_cache_mb: float = DEFAULT_CACHE_MAX_MB, keep: str = None):
+    """
+    Remove the least recently used entries, other than `keep`, until the
+    cache fits its limit. The key files (see `cache_entry`) count towards it,
+    and those of entries that are gone are removed.
+    """
+    entries_dir = os.path.join(cache_dir, "entries")
+    entries = []
+    for entry in os.scandir(entries_dir):
+        meta = os.path.join(entry.path, "meta.json")
+        if entry.path == keep or not entry.is_dir() or not os.path.exists(meta):
+            continue
+        size = sum(f.stat().st_size for f in os.scandir(entry.path))
+        entries.append((os.stat(meta).st_mtime, size, entry.path))
+
+    keys = []
+    keys_dir = os.path.join(cache_dir, "keys")
+    if os.path.isdir(keys_dir):
+        for key in os.scandir(keys_dir):
+            with open(key.path) as f:
+                digest = f.read().strip()
+            keys.append((os.path.join(entries_dir, digest), key))
+
+    total = sum(size for _, size, _ in entries)
+    total += sum(key.stat().st_size for _, key in keys)
+    if keep is not None:
+        total += sum(f.stat().st_size for f in os.scandir(keep))
+    limit = max_cache_mb * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        logger.debug(f"Evicting {path} from cache")
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+    for entry, key in keys:
+        if entry != keep and not os.path.exists(entry):
+            logger.debug(f"Removing the key of {entry} from cache")
+            os.remove(key.path)
@@ -0,0 +1,223 @@
+import argparse
+import os
+import time
+
+from loguru import logger
+from pandas import DataFrame
+
+from batch import find_files, group_by_meter, is_interval_file
+from export import backends
+from main import (
+    build_sheets,
+    concat_readings,
+    concatenate_files,
+    output_filename,
+    window_start,
+    write_workbook,
+)
+
+POLL_SECONDS = 5.0
+DEFAULT_DAEMON_MEMORY_MB = 512
+
+# Files modified more recently than this may still be being downloaded
+SETTLE_SECONDS = 2.0
+
+
+def poll(directory: str, seen: dict, settle: float = SETTLE_SECONDS) -> list[str]:
+    """
+    The CSV files in `directory` that are new or have changed size or
+    modification time since last seen, and have not been modified in the last
+    `settle` seconds. They are recorded in `seen`.
+    """
+    changed = []
+    now = time.time()
+    for file in find_files([directory]):
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            continue
+        key = (stat.st_size, stat.st_mtime_ns)
+        if seen.get(file) == key or now - stat.st_mtime < settle:
+            continue
+        seen[file] = key
+        changed.append(file)
+    return changed
+
+
+def max_per_day(data: DataFrame) -> DataFrame:
+    """
+    Reduce compact readings (see `main.compact_readings`) to one row per Read
+    Type and day, keeping the maximum Read Value, as the pivot would.
+    """
+    reduced = (
+        data.groupby(["Read Type", "day"], observed=True, sort=False)["Read Value"]
+        .max()
+        .reset_index()[list(data.columns)]
+    )
+    reduced.attrs = data.attrs
+    return reduced
+
+
+def memory_mb(meters: dict) -> float:
+    """The memory held by the resident readings of all meters"""
+    return sum(
+        meter["data"].memory_usage(deep=True).sum()
+        for meter in meters.values()
+        if meter["data"] is not None
+    ) / (1024 * 1024)
+
+
+def evict_idle(meters: dict, max_memory_mb: float = DEFAULT_DAEMON_MEMORY_MB):
+    """
+    Drop the readings of the least recently updated meters until the rest fit
+    in `max_memory_mb`. Their files are kept, so they are read again on
+    their next update.
+    """
+    resident = sorted(
+        (meter["used"], key)
+        for key, meter in meters.items()
+        if meter["data"] is not None
+    )
+    for _, key in resident:
+        if memory_mb(meters) <= max_memory_mb:
+            break
+        logger.info(f"Evicting idle meter {key} from memory")
+        meters[key]["data"] = None
+
+
+def update_meters(
+    meters: dict,
+    files: list[str],
+    days: int,
+    output_dir: str = ".",
+    backend: str = "openpyxl",
+) -> list[str]:
+    """
+    Merge new or changed files in to the resident readings of their meters,
+    and write the workbook of each meter whose readings changed.
+
+    :param meters: the state of each (MPRN, Meter Serial Number), a dict of
+        its "files", its resident "data" (None if evicted) and when it was
+        last "used". Updated in place.
+    :return: the workbooks written
+    """
+    written = []
+    for key, meter_files in group_by_meter(files).items():
+        try:
+            # Files can be removed, or not yet whole, while the daemon reads them
+            meter_files = [f for f in meter_files if not is_interval_file(f)]
+            if len(meter_files) == 0:
+                logger.warning(f"Interval files for {key} are not merged by the daemon")
+                continue
+
+            meter = meters.setdefault(key, {"files": [], "data": None, "used": 0.0})
+            reread = meter["data"] is None and len(meter["files"]) > 0
+            meter["files"] = sorted(set(meter["files"]) | set(meter_files))
+            meter["used"] = time.monotonic()
+
+            since = window_start(days)
+            data = concatenate_files(
+                meter["files"] if reread else meter_files, compact=True, since=since
+            )
+            if meter["data"] is not None:
+                data = concat_readings([meter["data"], data])
+            merged = max_per_day(data)
+
+            if (
+                not reread
+                and meter["data"] is not None
+                and merged.equals(meter["data"])
+            ):
+                logger.info(f"No new readings for {key}")
+                continue
+            meter["data"] = merged
+
+            daily, monthly = build_sheets(merged, days)
+            outfile = os.path.join(output_dir, output_filename(*key, days))
+            written.extend(write_workbook(daily, monthly, outfile, backend))
+        except Exception as e:
+            logger.error(f"Failed to update {key} from {meter_files}: {e}")
+
+    return written
+
+
+def watch(
+    directory: str,
+    days: int,
+    output_dir: str = ".",
+    backend: str = "openpyxl",
+    poll_seconds: float = POLL_SECONDS,
+    max_memory_mb: float = DEFAULT_DAEMON_MEMORY_MB,
+    settle: float = SETTLE_SECONDS,
+    iterations: int = None,
+) -> dict:
+    """
+    Watch `directory` for new HDF files, polling every `poll_seconds`.
+    The merged readings of each meter are kept in memory, so each new file
+    is read once and only the workbooks of meters it changes are written.
+    Idle meters are evicted to keep within `max_memory_mb`.
+
+    Runs until interrupted, or for `iterations` polls. Returns the meter state.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    seen = {}
+    meters = {}
+    logger.info(f"Watching {directory} every {poll_seconds}s...")
+
+    polls = 0
+    try:
+        while iterations is None or polls < iterations:
+            if polls > 0:
+                time.sleep(poll_seconds)
+            polls += 1
+
+            files = poll(directory, seen, settle)
+            if not files:
+                continue
+            logger.info(f"{len(files)} new files")
+            update_meters(meters, files, days, output_dir, backend)
+            evict_idle(meters, max_memory_mb)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+
+    return meters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Watch a directory for HDF files, updating each meter's spreadsheet."
+    )
+    parser.add_argument("days", type=int, help="Number of days to consider", default=7)
+    parser.add_argument("directory", type=str, help="Directory of HDF CSV files")
+    parser.add_argument(
+        "--output-dir", type=str, default=".", help="Directory for the spreadsheets"
+    )
+    parser.add_argument(
+        "--poll-seconds",
+        type=float,
+        default=POLL_SECONDS,
+        help="Seconds between checks for new files",
+    )
+    parser.add_argument(
+        "--max-memory-mb",
+        type=float,
+        default=DEFAULT_DAEMON_MEMORY_MB,
+        help="Memory budget in MB for readings held in memory",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(backends),
+        default="openpyxl",
+        help="How to write the Daily and Monthly sheets",
+    )
+
+    args = parser.parse_args()
+
+    watch(
+        args.directory,
+        args.days,
+        output_dir=args.output_dir,
+        backend=args.backend,
+        poll_seconds=args.poll_seconds,
+        max_memory_mb=args.max_memory_mb,
+    )
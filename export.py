@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import os
+import time
+from typing import TYPE_CHECKING
+
+from loguru import logger
+
+from main import lazy_import
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+
+# Loaded lazily, so the CLIs can list the backends without loading pandas
+pd = lazy_import("pandas")
+
+# The output backends, and the extension of the files they write
+backends = {
+    "openpyxl": "xlsx",
+    "xlsxwriter": "xlsx",
+    "ods": "ods",
+    "csv": "csv",
+    "parquet": "parquet",
+}
+
+DEFAULT_BACKEND = "openpyxl"
+
+
+def write_excel(sheets: dict[str, DataFrame], outfile: str, engine: str):
+    with pd.ExcelWriter(outfile, engine=engine) as writer:
+        for name, data in sheets.items():
+            data.to_excel(writer, sheet_name=name)
+
+
+def write_xlsx_streaming(sheets: dict[str, DataFrame], outfile: str):
+    """
+    Write the sheets with xlsxwriter in constant memory mode, where each row
+    is flushed to disk once the next is started. The rows are written in
+    order, with a header row per column level followed by the index name, as
+    `to_excel` lays them out.
+    """
+    import xlsxwriter
+
+    with xlsxwriter.Workbook(outfile, {"constant_memory": True}) as workbook:
+        for name, data in sheets.items():
+            worksheet = workbook.add_worksheet(name)
+
+            if isinstance(data.columns, pd.MultiIndex):
+                for level in range(data.columns.nlevels):
+                    worksheet.write_row(
+                        level,
+                        0,
+                        [data.columns.names[level]]
+                        + list(data.columns.get_level_values(level)),
+                    )
+                header_rows = data.columns.nlevels
+                worksheet.write(header_rows, 0, data.index.name)
+                header_rows += 1
+            else:
+                worksheet.write_row(0, 0, [data.index.name] + list(data.columns))
+                header_rows = 1
+
+            # Empty cells are left blank, as xlsxwriter cannot write NaN
+            values = data.astype(object).where(data.notna(), None)
+            for row, (label, cells) in enumerate(
+                zip(data.index, values.itertuples(index=False, name=None)),
+                start=header_rows,
+            ):
+                worksheet.write_row(row, 0, (label,) + cells)
+
+
+def output_files(
+    outfile: str, backend: str, sheet_names=("Daily", "Monthly")
+) -> list[str]:
+    """
+    The files a backend writes for `outfile`. Its extension is replaced with
+    the backend's, and backends without sheets write a file per sheet, named
+    <outfile>_<sheet>.<ext>
+    """
+    base = os.path.splitext(outfile)[0]
+    if backend in ("csv", "parquet"):
+        return [f"{base}_{name}.{backends[backend]}" for name in sheet_names]
+    return [f"{base}.{backends[backend]}"]
+
+
+def write_sheets(
+    sheets: dict[str, DataFrame], outfile: str, backend: str = DEFAULT_BACKEND
+) -> list[str]:
+    """
+    Write the Daily and Monthly sheets with the given output backend:
+
+    * openpyxl - an xlsx workbook written by pandas with openpyxl
+    * xlsxwriter - an xlsx workbook streamed in constant memory (needs xlsxwriter)
+    * ods - an OpenDocument spreadsheet written with odfpy
+    * csv - a CSV file per sheet
+    * parquet - a Parquet file per sheet (needs pyarrow)
+
+    The files are named as `output_files` describes. The time taken is logged.
+
+    :return: the files written
+    """
+    if backend not in backends:
+        raise ValueError(f"Unknown output backend {backend}")
+
+    outfiles = output_files(outfile, backend, list(sheets))
+    start = time.perf_counter()
+
+    if backend == "openpyxl":
+        write_excel(sheets, outfiles[0], "openpyxl")
+    elif backend == "xlsxwriter":
+        write_xlsx_streaming(sheets, outfiles[0])
+    elif backend == "ods":
+        write_excel(sheets, outfiles[0], "odf")
+    else:
+        for path, data in zip(outfiles, sheets.values()):
+            if backend == "csv":
+                data.to_csv(path)
+            else:
+                if isinstance(data.columns, pd.MultiIndex):
+                    # Parquet stores the levels, so drop any left unused
+                    data = data.set_axis(data.columns.remove_unused_levels(), axis=1)
+                data.to_parquet(path)
+
+    logger.info(
+        f"Wrote {', '.join(outfiles)} with {backend} "
+        f"in {time.perf_counter() - start:.3f}s"
+    )
+    return outfiles
@@ -0,0 +1,246 @@
+import argparse
+import math
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from pandas import DataFrame
+
+from batch import find_files, group_by_meter
+from export import backends, write_sheets
+from main import (
+    add_diff_columns,
+    concatenate_files,
+    extract_import_entries,
+    month_names,
+    window_start,
+)
+
+FLEET_FILE = "fleet_summary.xlsx"
+
+# Percentiles are estimated to within this relative error of the true value
+SKETCH_ACCURACY = 0.01
+sketch_gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+
+# Monthly totals of zero or less, as after a register is replaced, share
+# one bucket, estimated as 0
+ZERO_BUCKET = -(2**31)
+
+quantiles = [0.1, 0.5, 0.9]
+
+
+def sketch_buckets(values: np.ndarray) -> np.ndarray:
+    """
+    The bucket of each value in a log-bucketed histogram sketch. Bucket i
+    holds the values in (gamma^(i-1), gamma^i], so its midpoint is within
+    SKETCH_ACCURACY of all of them. Sketches are Counters of buckets, and
+    merge by adding their counts.
+    """
+    values = np.asarray(values, dtype=float)
+    buckets = np.full(len(values), ZERO_BUCKET, dtype=np.int64)
+    positive = values > 0
+    buckets[positive] = np.ceil(np.log(values[positive]) / math.log(sketch_gamma))
+    return buckets
+
+
+def sketch_quantile(sketch: Counter, q: float) -> float:
+    """The q quantile of the values counted in a sketch"""
+    buckets = sorted(sketch)
+    counts = np.cumsum([sketch[bucket] for bucket in buckets])
+    bucket = buckets[np.searchsorted(counts, q * (counts[-1] - 1), side="right")]
+    if bucket == ZERO_BUCKET:
+        return 0.0
+    return 2 * sketch_gamma**bucket / (sketch_gamma + 1)
+
+
+def monthly_totals(daily: DataFrame) -> DataFrame:
+    """
+    The kWh of each Read Type and month of a Daily sheet with diff columns
+    (see `add_diff_columns`), the sum of its daily diffs. Months without any
+    diffs are left out.
+    """
+    diff_columns = [
+        column for column in daily.columns if str(column[0]).endswith("_diff")
+    ]
+    months = daily.index.str.slice(0, 2).astype(int).to_numpy()
+    totals = daily[diff_columns].groupby(months).sum(min_count=1)
+
+    matrix = totals.to_numpy()
+    rows, columns = np.nonzero(~np.isnan(matrix))
+    read_types = np.array([str(column[0])[: -len("_diff")] for column in diff_columns])
+    years = np.array([column[1] for column in diff_columns])
+    return DataFrame(
+        {
+            "Read Type": read_types[columns],
+            "year": years[columns],
+            "month": totals.index.to_numpy()[rows],
+            "kWh": matrix[rows, columns],
+        }
+    )
+
+
+def add_totals(aggregates: dict, totals: DataFrame):
+    """
+    Fold one meter's monthly totals in to the running aggregates, a dict of
+    (Read Type, year, month) to its meters, sum of kWh and sketch.
+    """
+    buckets = sketch_buckets(totals["kWh"].to_numpy())
+    keys = zip(totals["Read Type"], totals["year"].tolist(), totals["month"].tolist())
+    for key, kwh, bucket in zip(keys, totals["kWh"].tolist(), buckets.tolist()):
+        entry = aggregates.setdefault(
+            key, {"meters": 0, "sum": 0.0, "sketch": Counter()}
+        )
+        entry["meters"] += 1
+        entry["sum"] += kwh
+        entry["sketch"][bucket] += 1
+
+
+def merge_aggregates(aggregates: dict, other: dict):
+    """Merge the aggregates of other meters in to `aggregates`, in place"""
+    for key, theirs in other.items():
+        entry = aggregates.setdefault(
+            key, {"meters": 0, "sum": 0.0, "sketch": Counter()}
+        )
+        entry["meters"] += theirs["meters"]
+        entry["sum"] += theirs["sum"]
+        entry["sketch"].update(theirs["sketch"])
+
+
+def meter_aggregates(files: list[str], days: int) -> dict:
+    """
+    The aggregates of one meter, from its Daily sheet. Only they are
+    returned, so the readings are freed before the next meter is read.
+    """
+    aggregates = {}
+    try:
+        data = concatenate_files(files, compact=True, since=window_start(days))
+        # Months without use are kept as zeros, not left out
+        daily = add_diff_columns(extract_import_entries(data, days), zero_to_nan=False)
+        add_totals(aggregates, monthly_totals(daily))
+    except Exception as e:
+        logger.error(f"Failed to aggregate {files}: {e}")
+    return aggregates
+
+
+def summarise(aggregates: dict) -> DataFrame:
+    """
+    The fleet's meters, total, mean and percentiles per meter of each Read
+    Type, year and month
+    """
+    keys = sorted(aggregates)
+    summary = DataFrame(
+        {
+            "meters": [aggregates[key]["meters"] for key in keys],
+            "total_kWh": [aggregates[key]["sum"] for key in keys],
+        },
+        index=pd.MultiIndex.from_tuples(keys, names=["Read Type", "year", "month"]),
+    )
+    summary["mean_kWh"] = summary["total_kWh"] / summary["meters"]
+    for q in quantiles:
+        summary[f"p{q * 100:.0f}_kWh"] = [
+            sketch_quantile(aggregates[key]["sketch"], q) for key in keys
+        ]
+    return summary
+
+
+def year_on_year(summary: DataFrame) -> DataFrame:
+    """
+    The mean kWh per meter of each Read Type and month by year, and its
+    change in percent from the year before
+    """
+    means = summary["mean_kWh"].unstack("year")
+    changes = means.pct_change(axis=1, fill_method=None) * 100
+    changes = changes.iloc[:, 1:]
+    result = pd.concat(
+        [means, changes], axis=1, keys=["mean_kWh", "change_%"], names=["", "year"]
+    )
+    return result.rename(index=dict(enumerate(month_names, 1)), level="month")
+
+
+def fleet_report(
+    inputs: list[str],
+    days: int,
+    workers: int | None = None,
+    outfile: str = FLEET_FILE,
+    backend: str = "openpyxl",
+) -> DataFrame:
+    """
+    Aggregate the readings of every meter in `inputs` (files, directories or
+    glob patterns) in to one summary workbook, without holding more than one
+    meter's readings per worker in memory. Each meter's monthly totals are
+    folded in to running sums and mergeable percentile sketches, across a
+    pool of `workers` processes (default: one per CPU), or in this process
+    if `workers` is 1.
+
+    The workbook has a Monthly sheet (see `summarise`) and a Year on year
+    sheet (see `year_on_year`).
+
+    :return: the Monthly summary
+    """
+    meters = group_by_meter(find_files(inputs))
+    logger.info(f"Fleet report started for {len(meters)} meters...")
+
+    aggregates = {}
+    if workers == 1:
+        for files in meters.values():
+            merge_aggregates(aggregates, meter_aggregates(files, days))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for partial in executor.map(
+                meter_aggregates, meters.values(), [days] * len(meters)
+            ):
+                merge_aggregates(aggregates, partial)
+
+    if not aggregates:
+        raise ValueError("No readings aggregated from the files")
+
+    summary = summarise(aggregates)
+    sheets = {
+        "Monthly": summary.rename(index=dict(enumerate(month_names, 1)), level="month"),
+        "Year on year": year_on_year(summary),
+    }
+    outfiles = write_sheets(sheets, outfile, backend)
+    logger.info(f"Fleet report of {len(meters)} meters written to {outfiles[0]}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarise the readings of many meters in one spreadsheet."
+    )
+    parser.add_argument("days", type=int, help="Number of days to consider", default=7)
+    parser.add_argument(
+        "inputs",
+        type=str,
+        nargs="+",
+        help="HDF CSV files, directories or glob patterns",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--output", type=str, default=FLEET_FILE, help="The summary spreadsheet"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(backends),
+        default="openpyxl",
+        help="How to write the summary sheets",
+    )
+
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    fleet_report(
+        args.inputs,
+        args.days,
+        workers=args.workers,
+        outfile=args.output,
+        backend=args.backend,
+    )
@@ -1,16 +1,89 @@
+from __future__ import annotations
+
 import argparse
+import csv
+import importlib.util
+import math
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
-import numpy as np
-import pandas as pd
 from datetime import datetime, timedelta
 from loguru import logger
-from pandas import DataFrame
+
+from metrics import log_metrics, profiled, stage, write_metrics
+
+if TYPE_CHECKING:
+    from pandas import DataFrame, Series
+
+
+def lazy_import(name: str):
+    """
+    Import a module on first use of one of its attributes, so that `--help`,
+    argument errors and the `--latest` query start without loading it.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+def load_lazy_modules():
+    """
+    Finish loading numpy and pandas. Lazy modules are not safe to load from
+    several threads at once, so this is called before a thread pool uses
+    them. Accessing an attribute is what loads them.
+    """
+    return np.ndarray, pd.DataFrame
+
 
 dtype_spec = {
     "MPRN": str,
     "Meter Serial Number": str,
 }
 
+# The format of "Read Date and End Time" in HDF files, e.g. 19-12-2024 00:00
+hdf_date_format = "%d-%m-%Y %H:%M"
+
+# Columns read as text, so MPRNs and serial numbers keep their leading zeros
+text_columns = ["MPRN", "Meter Serial Number", "Read Type", "Read Date and End Time"]
+
+# A reading is unique per meter, register and date. Later files may correct
+# earlier ones, in which case the maximum value is kept.
+reading_key = ["MPRN", "Meter Serial Number", "Read Type", "Read Date and End Time"]
+
+# e.g. HDF_Daily_kWh_01234567890_20-12-2024.csv or HDF_DailyDNP_kWh_...
+hdf_filename = re.compile(r"^HDF_\w+?_(?P<mprn>\d+)_(?P<date>\d{2}-\d{2}-\d{4})\.csv$")
+
+# 30 minute interval files have Read Types like "Active Import Interval (kW)".
+# They are resampled to the daily registers below, by the start of each
+# interval: peak 17:00-19:00, day 08:00-23:00 otherwise, and night the rest.
+interval_minutes = 30
+interval_registers = [
+    "Night Import Register (kWh)",
+    "Day Off-Peak Import Register (kWh)",
+    "Day Peak Import Register (kWh)",
+    "24 Hr Active Export Register (kWh)",
+    "24 Hr Active Import Register (kWh)",
+]
+
+STREAM_CHUNK_ROWS = 50_000
+WINDOW_CHUNK_ROWS = 5_000
+DEFAULT_MAX_MEMORY_MB = 256
+# The streaming buffer is compacted again only once it has grown by this
+# factor over its last compacted size
+COMPACT_GROWTH = 2
+
 
 def read_csv(file_path):
     try:
@@ -21,7 +94,391 @@ def read_csv(file_path):
         return None
 
 
-def extract_import_entries(data: DataFrame, days: int = 7) -> DataFrame:
+def read_csv_arrow(file_path):
+    """
+    Read a CSV file with the pyarrow CSV reader, which releases the GIL
+    while parsing. Falls back to `read_csv` if pyarrow is not installed.
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        return read_csv(file_path)
+
+    try:
+        options = pa_csv.ConvertOptions(
+            column_types={column: pa.string() for column in text_columns}
+        )
+        return pa_csv.read_csv(file_path, convert_options=options).to_pandas()
+    except Exception as e:
+        logger.error(f"Error reading CSV file {file_path}: {e}")
+        return None
+
+
+def read_csv_chunks(file_path, chunksize: int = STREAM_CHUNK_ROWS):
+    """
+    Read a CSV file lazily in chunks of at most `chunksize` rows.
+    Errors are logged and end the iteration, like `read_csv` returning None.
+    """
+    try:
+        yield from pd.read_csv(file_path, dtype=dtype_spec, chunksize=chunksize)
+    except Exception as e:
+        logger.error(f"Error reading CSV file {file_path}: {e}")
+
+
+def file_date(file_path: str) -> datetime | None:
+    """The download date embedded in a HDF filename, if there is one"""
+    match = hdf_filename.match(os.path.basename(file_path))
+    if match is None:
+        return None
+    return datetime.strptime(match.group("date"), "%d-%m-%Y")
+
+
+def peek_read_date(file_path: str) -> datetime | None:
+    """
+    The "Read Date and End Time" of the first row of a HDF file, which is
+    its newest reading, without parsing the rest of it.
+    """
+    try:
+        with open(file_path, newline="") as f:
+            row = next(csv.DictReader(f), None)
+        return datetime.strptime(row["Read Date and End Time"], hdf_date_format)
+    except Exception:
+        return None
+
+
+def tail_read_date(file_path: str) -> datetime | None:
+    """
+    The "Read Date and End Time" of the last row of a HDF file, which is its
+    oldest reading, read from the end of the file without parsing the rest.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 1024, 0))
+            last = f.read().decode(errors="replace").strip().splitlines()[-1]
+        return datetime.strptime(last.rsplit(",", 1)[-1].strip(), hdf_date_format)
+    except Exception:
+        return None
+
+
+def window_start(days: float) -> datetime:
+    """
+    The first midnight within the last `days` days, from which readings are
+    kept by `extract_import_entries`. Windows reaching back before the year 1
+    start at `datetime.min`.
+    """
+    epoch = datetime(1970, 1, 1)
+    try:
+        n_days_ago = datetime.now() - timedelta(days=days)
+    except OverflowError:
+        return datetime.min
+    return epoch + timedelta(days=math.ceil((n_days_ago - epoch) / timedelta(days=1)))
+
+
+def outside_window(file_path: str, since: datetime) -> bool:
+    """
+    Whether a HDF file cannot hold readings from `since` on, as its
+    download date (from its filename, or else its first row) is earlier.
+    """
+    newest = file_date(file_path) or peek_read_date(file_path)
+    return newest is not None and newest < since
+
+
+def read_csv_window(
+    file_path, since: datetime, chunksize: int = WINDOW_CHUNK_ROWS
+) -> DataFrame:
+    """
+    Read only the rows of a HDF file dated `since` or later.
+
+    HDF files are written newest first, so the file is read in chunks of
+    `chunksize` rows and reading stops at the first chunk ending before
+    `since`, leaving the older rows unparsed. Files whose oldest row is in
+    the window are read whole. Returns None if the file has
+    no rows in the window or cannot be read.
+    """
+    # A window starting before the oldest reading keeps the whole file
+    oldest = tail_read_date(file_path)
+    if oldest is not None and oldest >= since:
+        data = read_csv(file_path)
+        return None if data is None or data.empty else data
+
+    parts = []
+    for chunk in read_csv_chunks(file_path, chunksize):
+        dates = parse_read_dates(chunk["Read Date and End Time"])
+        parts.append(chunk[(dates >= since).to_numpy()])
+        if dates.iloc[-1] < since:
+            break
+
+    data = pd.concat(parts) if len(parts) > 1 else next(iter(parts), None)
+    if data is None or data.empty:
+        return None
+    return data
+
+
+def latest_readings(files: list[str]) -> dict[str, tuple[datetime, float]]:
+    """
+    The latest reading of each Read Type in the files, as (date, value).
+    Read with the csv module, without loading pandas, for quick queries.
+    Where files disagree the maximum value is taken, as in the pipeline.
+    """
+    latest = {}
+    for file in files:
+        with open(file, newline="") as f:
+            for row in csv.DictReader(f):
+                try:
+                    reading = (
+                        datetime.strptime(
+                            row["Read Date and End Time"], hdf_date_format
+                        ),
+                        float(row["Read Value"]),
+                    )
+                except (TypeError, ValueError):
+                    continue
+                if reading > latest.get(row["Read Type"], (datetime.min, 0.0)):
+                    latest[row["Read Type"]] = reading
+    return latest
+
+
+def max_per_reading(data: DataFrame) -> DataFrame:
+    """
+    Reduce a data frame to one row per MPRN, Meter Serial Number, Read Type and
+    date, keeping the maximum Read Value. The column order is preserved.
+    """
+    reduced = data.groupby(reading_key, sort=False, as_index=False, observed=True)[
+        "Read Value"
+    ].max()
+    return reduced[list(data.columns)]
+
+
+def is_interval(data: DataFrame) -> bool:
+    """Whether the data is from a 30 minute interval file"""
+    return len(data) > 0 and " Interval " in str(data["Read Type"].iloc[0])
+
+
+def resample_intervals(data: DataFrame) -> DataFrame:
+    """
+    Resample 30 minute interval readings to daily cumulative registers, in
+    the layout of a Daily HDF file, so they can be pivoted like one.
+
+    Readings in kW are average demand over the interval, so are halved to
+    kWh. Each interval is binned by the day and hour it starts at (its
+    "Read Date and End Time" less 30 minutes) in one `np.bincount` over all
+    readings. The daily totals of each bucket are then summed in to
+    registers read at midnight, starting from 0 at midnight of the first day.
+    Missing intervals count as no usage.
+
+    We expect only one MPRN and one Meter Serial Number in the data frame.
+    """
+    mprns = data["MPRN"].unique()
+    assert len(mprns) == 1, "More than one MPRN in the data"
+
+    msns = data["Meter Serial Number"].unique()
+    assert len(msns) == 1, "More than one Meter Serial Number in the data"
+
+    # Only the few distinct Read Types are inspected, not every row
+    codes, read_types = pd.factorize(data["Read Type"])
+    read_types = read_types.astype(str)
+    export = read_types.str.contains("Export")[codes]
+    kw = read_types.str.endswith("(kW)")[codes]
+    kwh = data["Read Value"].to_numpy(dtype=float)
+    kwh = np.nan_to_num(kwh * np.where(kw, interval_minutes / 60, 1.0))
+
+    ends = parse_read_dates(data["Read Date and End Time"]).to_numpy("datetime64[m]")
+    starts = ends - np.timedelta64(interval_minutes, "m")
+    days = starts.astype("datetime64[D]")
+    hours = (starts - days).astype(int) // 60
+
+    # The index of each reading's register in interval_registers
+    bucket = np.where((hours >= 8) & (hours < 23), 1, 0)
+    bucket = np.where((hours >= 17) & (hours < 19), 2, bucket)
+    bucket = np.where(export, 3, bucket)
+
+    first_day = days.min()
+    day = (days - first_day).astype(int)
+    n_days = day.max() + 1
+    usage = np.bincount(day * 4 + bucket, weights=kwh, minlength=n_days * 4)
+    usage = usage.reshape(n_days, 4)
+    usage = np.column_stack([usage, usage[:, :3].sum(axis=1)])
+
+    registers = np.zeros((n_days + 1, len(interval_registers)))
+    registers[1:] = np.cumsum(usage, axis=0)
+
+    present = [bool((~export).any())] * 3 + [bool(export.any()), bool((~export).any())]
+    registers = registers[:, present]
+    names = np.array(interval_registers)[present]
+
+    read_dates = first_day + np.arange(n_days + 1)
+    read_dates = pd.DatetimeIndex(read_dates[::-1]).strftime(hdf_date_format)
+    n_registers = len(names)
+    return pd.DataFrame(
+        {
+            "MPRN": mprns[0],
+            "Meter Serial Number": msns[0],
+            "Read Value": registers[::-1].ravel(),
+            "Read Type": np.tile(names, n_days + 1),
+            "Read Date and End Time": np.repeat(read_dates, n_registers),
+        }
+    )
+
+
+def parse_read_dates(dates: Series) -> Series:
+    """
+    Parse "Read Date and End Time" with the fixed HDF date format.
+    Any rows that do not match the format are parsed again, day first, with
+    the format inferred per element. Already parsed dates are returned as is.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+
+    parsed = pd.to_datetime(dates, format=hdf_date_format, errors="coerce")
+
+    malformed = parsed.isna() & dates.notna()
+    if malformed.any():
+        logger.warning(
+            f"{malformed.sum()} dates not in the format {hdf_date_format}. "
+            f"First is '{dates[malformed].iloc[0]}'"
+        )
+        parsed[malformed] = pd.to_datetime(
+            dates[malformed], dayfirst=True, format="mixed"
+        )
+
+    return parsed
+
+
+def month_day_labels(codes) -> list[str]:
+    """Labels like 12-17 for integer month-day codes like 1217"""
+    return [f"{code // 100:02d}-{code % 100:02d}" for code in codes]
+
+
+def compact_readings(data: DataFrame) -> DataFrame:
+    """
+    Convert data in the HDF file layout to the compact reading representation
+    used by `extract_import_entries`:
+
+    * Read Value - float64
+    * Read Type - categorical
+    * day - int32 days since 1970-01-01 of "Read Date and End Time"
+
+    We expect only one MPRN and one Meter Serial Number in the data frame.
+    They are held once as attributes, rather than repeated on every row.
+    Frames that are already compact are returned as they are.
+    """
+    if is_compact(data):
+        return data
+
+    # Frames without readings can hold their meter as attributes instead
+    # (see `empty_readings`)
+    if data.empty and "MPRN" in data.attrs:
+        mprns = [data.attrs["MPRN"]]
+        msns = [data.attrs["Meter Serial Number"]]
+    else:
+        mprns = data["MPRN"].unique()
+        msns = data["Meter Serial Number"].unique()
+    assert len(mprns) == 1, "More than one MPRN in the data"
+    assert len(msns) == 1, "More than one Meter Serial Number in the data"
+
+    dates = parse_read_dates(data["Read Date and End Time"]).to_numpy()
+    valid = ~np.isnat(dates)
+
+    compact = pd.DataFrame(
+        {
+            "Read Value": data["Read Value"].to_numpy(dtype=float)[valid],
+            "Read Type": pd.Categorical(data["Read Type"].to_numpy()[valid]),
+            "day": dates[valid].astype("datetime64[D]").astype(np.int32),
+        }
+    )
+    compact.attrs["MPRN"] = mprns[0]
+    compact.attrs["Meter Serial Number"] = msns[0]
+    return compact
+
+
+def empty_readings(file_path: str) -> DataFrame | None:
+    """
+    No readings, in the HDF layout, with the MPRN and Meter Serial Number of
+    the first row of a HDF file as attributes. For a window that has none of
+    the meter's readings. Returns None if the file has no whole rows.
+    """
+    head = next(read_csv_chunks(file_path, 1), None)
+    if head is None or head.empty or head.iloc[0].isna().any():
+        return None
+    data = head.iloc[:0].copy()
+    data.attrs["MPRN"] = head["MPRN"].iloc[0]
+    data.attrs["Meter Serial Number"] = head["Meter Serial Number"].iloc[0]
+    return data
+
+
+def is_compact(data: DataFrame) -> bool:
+    return "day" in data.columns and "MPRN" not in data.columns
+
+
+def concat_readings(frames: list[DataFrame]) -> DataFrame:
+    """
+    Concatenate compact readings of the same meter, keeping Read Type
+    categorical across frames with different registers.
+    """
+    frames = [frame for frame in frames if frame is not None]
+    for frame in frames[1:]:
+        assert frame.attrs == frames[0].attrs, "More than one meter in the data"
+
+    read_types = pd.api.types.union_categoricals(
+        [frame["Read Type"] for frame in frames], sort_categories=True
+    )
+    data = pd.concat(
+        [frame.drop(columns="Read Type") for frame in frames], ignore_index=True
+    )
+    data.insert(1, "Read Type", read_types)
+    data.attrs = dict(frames[0].attrs)
+    return data
+
+
+def pivot_max(
+    values: np.ndarray, read_types: pd.Categorical, month_day: np.ndarray, years
+) -> DataFrame:
+    """
+    Pivot readings to a month_day x (Read Type, year) frame, keeping the
+    maximum value of each cell, like `pivot_table(aggfunc="max")`.
+
+    The key space is small and dense (month-day codes are below 1232), so
+    each reading's cell is computed as a flat integer offset and the values
+    are scattered straight in to a preallocated array with `np.fmax.at`,
+    which ignores NaN values. Rows and columns with no values are dropped,
+    as `pivot_table` does.
+    """
+    known = read_types.codes >= 0
+    type_codes = read_types.codes[known].astype(np.intp)
+    years = np.asarray(years)[known]
+
+    first_year = years.min() if len(years) else 0
+    n_years = years.max() - first_year + 1 if len(years) else 0
+    n_columns = len(read_types.categories) * n_years
+    column = type_codes * n_years + (years - first_year)
+    cell = month_day[known].astype(np.intp) * n_columns + column
+
+    matrix = np.full(1232 * n_columns, np.nan)
+    np.fmax.at(matrix, cell, values[known])
+    matrix = matrix.reshape(1232, n_columns)
+
+    has_rows = ~np.isnan(matrix).all(axis=1)
+    has_columns = ~np.isnan(matrix).all(axis=0)
+    columns = pd.MultiIndex.from_product(
+        [
+            read_types.categories.astype(object),
+            np.arange(first_year, first_year + n_years, dtype=years.dtype),
+        ],
+        names=["Read Type", "year"],
+    )[has_columns].remove_unused_levels()
+
+    return pd.DataFrame(
+        matrix[np.ix_(has_rows, has_columns)],
+        index=pd.Index(np.flatnonzero(has_rows), name="month_day"),
+        columns=columns,
+    )
+
+
+def extract_import_entries(
+    data: DataFrame, days: int = 7, pivot: str = "numpy"
+) -> DataFrame:
     """
     Takes a data frame with date, value and type columns and pivots it to
     day in year with type and year in columns.
@@ -31,189 +488,744 @@ def extract_import_entries(data: DataFrame, days: int = 7) -> DataFrame:
     We expect only one MPRN and one Meter Serial Number in the data frame.
     We remove them from the columns and add them as an attribute.
 
-    :param data: A data frame containing many concatenated files
+    :param data: A data frame containing many concatenated files, either in the
+        HDF file layout or the compact layout of `compact_readings`
     :param days: number of days old data to extract
+    :param pivot: "numpy" to pivot with `pivot_max`, or "pandas" to use
+        `DataFrame.pivot_table`
     :return: A dataframe pivoted by day of year
     """
-    mprns = data["MPRN"].unique()
-    assert len(mprns) == 1, "More than one MPRN in the data"
+    data = compact_readings(data)
 
-    msns = data["Meter Serial Number"].unique()
-    assert len(msns) == 1, "More than one Meter Serial Number in the data"
+    # Filter out older than n days
+    first_day = (window_start(days) - datetime(1970, 1, 1)).days
+    last_n_days_data = data[data["day"] >= first_day]
 
-    n_days_ago = datetime.now() - timedelta(days=days)
-    data["date"] = pd.to_datetime(data["Read Date and End Time"], dayfirst=True)
-    data["month_day"] = data["date"].dt.strftime("%m-%d")
-    data["year"] = data["date"].dt.year
-    last_n_days_data = data[data["date"] >= n_days_ago]  # Filter out older than n days
-    last_n_days_data = last_n_days_data.drop(
-        columns=["Read Date and End Time", "MPRN", "Meter Serial Number"]
-    )
+    # Pivot on an integer month-day code (e.g. 1217), rather than formatting
+    # every date as a string. Only the index is labelled afterwards.
+    dates = last_n_days_data["day"].to_numpy().astype("datetime64[D]")
+    months = dates.astype("datetime64[M]")
+    month_day = (months.astype(int) % 12 + 1) * 100 + (dates - months).astype(int) + 1
+    years = dates.astype("datetime64[Y]").astype(np.int32) + 1970
 
-    last_n_days_data = last_n_days_data.pivot_table(
-        index=["month_day"],
-        values="Read Value",
-        columns=["Read Type", "year"],
-        aggfunc="max",
+    if pivot == "numpy":
+        last_n_days_data = pivot_max(
+            last_n_days_data["Read Value"].to_numpy(),
+            last_n_days_data["Read Type"].array,
+            month_day,
+            years,
+        )
+    else:
+        last_n_days_data = pd.DataFrame(
+            {
+                "Read Value": last_n_days_data["Read Value"].to_numpy(),
+                "Read Type": last_n_days_data["Read Type"].array,
+                "month_day": month_day,
+                "year": years,
+            }
+        ).pivot_table(
+            index=["month_day"],
+            values="Read Value",
+            columns=["Read Type", "year"],
+            aggfunc="max",
+            observed=True,
+        )
+    last_n_days_data.index = pd.Index(
+        month_day_labels(last_n_days_data.index), name="month_day"
+    )
+    last_n_days_data.columns = last_n_days_data.columns.set_levels(
+        last_n_days_data.columns.levels[0].astype(object), level=0
     )
 
-    last_n_days_data.attrs["MPRN"] = mprns[0]
-    last_n_days_data.attrs["Meter Serial Number"] = msns[0]
+    last_n_days_data.attrs["MPRN"] = data.attrs["MPRN"]
+    last_n_days_data.attrs["Meter Serial Number"] = data.attrs["Meter Serial Number"]
 
     return last_n_days_data
 
 
+month_names = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+
+
+def label_months(labels) -> np.ndarray:
+    """
+    The integer month (1-12) of month-day labels like 12-17. The labels are
+    fixed width, so the month is read from the first two characters of each
+    as code points, rather than splitting strings.
+    """
+    chars = np.asarray(labels, dtype="U5").view(np.uint32).reshape(-1, 5)
+    return (chars[:, 0] - ord("0")) * 10 + chars[:, 1] - ord("0")
+
+
 def by_month(data: DataFrame) -> DataFrame:
-    data["month"] = data.index.str.split("-").str[0]
+    """
+    The maximum of each column per month of a month-day indexed frame, with a
+    row for every month from January to December.
 
-    data["month"] = data["month"].replace(
-        {
-            "01": "January",
-            "02": "February",
-            "03": "March",
-            "04": "April",
-            "05": "May",
-            "06": "June",
-            "07": "July",
-            "08": "August",
-            "09": "September",
-            "10": "October",
-            "11": "November",
-            "12": "December",
-        }
-    )
+    The rows of each month are contiguous once sorted by month, so the
+    maxima are taken in one `np.fmax.reduceat` over the whole matrix, which
+    skips NaN values as `groupby().max()` does. `data` is not modified.
+    """
+    months = label_months(data.index)
+    order = np.argsort(months, kind="stable")
+    months = months[order]
+    values = data.to_numpy(dtype=float)[order]
 
-    data_by_month = data.groupby("month").max()
-    data_by_month = data_by_month.reindex(
-        [
-            "January",
-            "February",
-            "March",
-            "April",
-            "May",
-            "June",
-            "July",
-            "August",
-            "September",
-            "October",
-            "November",
-            "December",
-        ]
-    )
+    result = np.full((12, data.shape[1]), np.nan)
+    if len(months) > 0:
+        starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        result[months[starts] - 1] = np.fmax.reduceat(values, starts, axis=0)
 
+    data_by_month = pd.DataFrame(
+        result, index=pd.Index(month_names, name="month"), columns=data.columns
+    )
+    data_by_month.attrs = data.attrs
     return data_by_month
 
 
+def is_leap_year(years: np.ndarray) -> np.ndarray:
+    return (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+
+
+def chronological_diffs(data: DataFrame) -> np.ndarray:
+    """
+    The difference of every cell of a (Read Type, year) pivot from the
+    reading before it in time, as a matrix the shape of `data`.
+
+    The cells of each Read Type are laid end to end in date order (year by
+    year, with the rows in date order within a year) in to one series. It is
+    forward filled and differenced in a single pass over all Read Types, then
+    put back in place. So the first days of a year follow on from the last
+    reading of the year before, or of an earlier year if one is missing, and
+    a gap is bridged by the first reading after it. Days with no reading
+    before them, and 29 February of other years, have no difference.
+    """
+    raw = data.to_numpy(dtype=float)
+    n_rows, n_columns = raw.shape
+    if raw.size == 0:
+        return np.full_like(raw, np.nan)
+
+    type_codes = pd.factorize(data.columns.get_level_values(0))[0]
+    years = np.asarray(data.columns.get_level_values(1), dtype=int)
+
+    # Cells column by column, with the columns ordered by Read Type then year
+    order = np.lexsort((years, type_codes))
+    series = raw[:, order].T.ravel()
+    positions = np.arange(series.size)
+    type_start = np.r_[True, type_codes[order][1:] != type_codes[order][:-1]]
+    starts = np.zeros(series.size, dtype=bool)
+    starts[::n_rows] = type_start
+
+    # Forward fill within each Read Type, by carrying forward the position of
+    # the last reading. The start of each Read Type stops the carry.
+    anchors = ~np.isnan(series) | starts
+    filled = series[np.maximum.accumulate(np.where(anchors, positions, 0))]
+
+    diffs = np.empty_like(filled)
+    diffs[0] = np.nan
+    diffs[1:] = filled[1:] - filled[:-1]
+    diffs[starts] = np.nan
+
+    result = np.empty_like(raw)
+    result[:, order] = diffs.reshape(n_columns, n_rows).T
+
+    leap_day = np.asarray(data.index == "02-29")
+    result[np.ix_(leap_day, ~is_leap_year(years))] = np.nan
+    return result
+
+
 def add_diff_columns(data: DataFrame, zero_to_nan: bool = True) -> DataFrame:
-    columns_list = list(data.columns)
+    """
+    Add a diff column for every (Read Type, year) column, named
+    (Read Type + "_diff", year), after forward filling any empty cells.
+
+    The diffs are taken in date order across the years (see
+    `chronological_diffs`), so the first reading of each year is the
+    difference from the last reading of the years before.
+    """
+    # A pivot without readings has no columns to diff
+    if data.shape[1] == 0:
+        return data
+
+    diffs = chronological_diffs(data)
 
     # Forward-fill any empty values cells with data from last good value
     data = data.ffill(axis=0)
+    # Cells before the first reading of their year stay empty
+    diffs[data.isna().to_numpy()] = np.nan
 
-    for column in columns_list:
-        # Add a diff column to the dataframe
-        # This uses the pandas diff function to calculate the difference
-        # between the current and previous value in the column
-        # This does no work where the data is wrapped over from the previous
-        # year - that requires an extra function.
-        data.loc[:, (str(column[0]) + "_diff", column[1])] = data.loc[
-            :, (column[0], column[1])
-        ].diff()
-
-        try:
-            _ = columns_list.index((column[0], column[1] - 1))
-            first_index = data.index[0]
-            last_index = data.index[-1]
-            end_last_year = data.loc[last_index, (column[0], column[1] - 1)]
-            start_this_year = data.loc[first_index, (column[0], column[1])]
-            data.loc[first_index, (str(column[0]) + "_diff", column[1])] = (
-                start_this_year - end_last_year
-            )
-        except ValueError:
-            pass  # No previous year data
-
-        if zero_to_nan:
-            # Zero difference means there's no difference in a day
-            # Usually only possible for export, as everything else will
-            # change daily
-            data[str(column[0]) + "_diff", column[1]] = data[
-                str(column[0]) + "_diff", column[1]
-            ].replace(0, np.nan)
+    if zero_to_nan:
+        # Zero difference means there's no difference in a day
+        # Usually only possible for export, as everything else will
+        # change daily
+        diffs[diffs == 0] = np.nan
 
-    return data
+    diff_columns = pd.MultiIndex.from_arrays(
+        [
+            [
+                str(read_type) + "_diff"
+                for read_type in data.columns.get_level_values(0)
+            ],
+            data.columns.get_level_values(1),
+        ],
+        names=data.columns.names,
+    )
+    result = pd.concat(
+        [data, pd.DataFrame(diffs, index=data.index, columns=diff_columns)], axis=1
+    )
+    result.attrs = data.attrs
+    return result
 
 
-def concatenate_files(files: list[str]) -> DataFrame:
+def concatenate_files(
+    files: list[str],
+    stream: bool = False,
+    chunksize: int = STREAM_CHUNK_ROWS,
+    max_memory_mb: float = DEFAULT_MAX_MEMORY_MB,
+    cache_dir: str = None,
+    max_cache_mb: float = None,
+    compact: bool = False,
+    since: datetime = None,
+    workers: int = None,
+    scan: bool = False,
+) -> DataFrame:
     """
     Accept multiple files and concatenate them into a single DataFrame.
     The files need to be of the same witdh and the same columns.
     The nature of smart meter files means that data can be missing from
     time to time, and so the script will fill the missing data from later files
     if it becomes available.
+
+    :param files: the HDF files to read, in order
+    :param stream: read the files in chunks and keep only the maximum value per
+        date and Read Type as they are read (see `concatenate_files_streaming`)
+    :param chunksize: number of rows per chunk when streaming
+    :param max_memory_mb: memory ceiling for buffered chunks when streaming
+    :param cache_dir: read the files through a cache of parsed files in this
+        directory (see `cache.read_cached_csv`). Not used when streaming.
+    :param max_cache_mb: size limit of the cache directory
+    :param compact: convert each file to the compact reading representation
+        (see `compact_readings`) as it is read. Not used when streaming.
+    :param since: read only the readings from this date on (see
+        `window_start`). Files downloaded before it are skipped, and the rest
+        read only as far as the window with `read_csv_window`, unless read
+        through the cache. Not used when streaming.
+    :param workers: parse the files on a pool of this many threads, with
+        `read_csv_arrow`, keeping the rows from `since` on. The results are
+        still checked and concatenated in file order. Not used when streaming.
+    :param scan: read the files straight in to compact readings with
+        `scanner.scan_csv`, falling back to pandas for other layouts. Implies
+        `compact`. Not used when streaming or reading through the cache.
     """
 
     if len(files) < 1:
         logger.error("No files provided")
         raise ValueError("No files provided")
 
-    data1 = read_csv(files[0])
+    if stream:
+        return concatenate_files_streaming(files, chunksize, max_memory_mb)
+
+    # The default window, of all readings, is no window
+    if since == datetime.min:
+        since = None
+
+    if cache_dir is not None:
+        from cache import DEFAULT_CACHE_MAX_MB, read_cached_csv
+
+        def read(file):
+            return read_cached_csv(
+                file, cache_dir, max_cache_mb or DEFAULT_CACHE_MAX_MB
+            )
+
+    elif scan:
+        from scanner import scan_csv
+
+        compact = True
+
+        def read(file):
+            return scan_csv(file, since)
+
+    elif workers is not None and workers > 1:
+
+        def read(file):
+            data = read_csv_arrow(file)
+            if since is None or data is None:
+                return data
+            dates = parse_read_dates(data["Read Date and End Time"])
+            data = data[(dates >= since).to_numpy()]
+            return None if data.empty else data
+
+    elif since is not None:
+
+        def read(file):
+            return read_csv_window(file, since)
+
+    else:
+        read = read_csv
 
-    for file in files[1:]:
-        data = read_csv(file)
-        if data1.shape[1] > data.shape[1]:
+    def load(file):
+        """The width of a file as read, and its (compacted) data"""
+        if since is not None and outside_window(file, since):
+            logger.info(
+                f"Skipping {file}, which has no readings since {since:%d-%m-%Y}"
+            )
+            return None
+
+        data = read(file)
+        if data is None:
+            return None
+        if is_compact(data):
+            # Scanned files are compact already, and only the HDF layout is
+            # scanned
+            return len(text_columns) + 1, data
+        if compact and not is_interval(data):
+            return data.shape[1], compact_readings(data)
+        return data.shape[1], data
+
+    if workers is not None and workers > 1 and len(files) > 1:
+        load_lazy_modules()
+        with ThreadPoolExecutor(workers) as pool:
+            loaded = list(pool.map(load, files))
+    else:
+        loaded = map(load, files)
+
+    frames = []
+    intervals = []
+    width = None
+    for result in loaded:
+        if result is None:
+            continue
+        data_width, data = result
+
+        if width is None:
+            width = data_width
+        elif width > data_width:
             logger.error("Data does not match columns of Data1")
 
-        # Concatenate the data, but leave out the first row of the new data
-        data1 = pd.concat([data1, data])
+        (intervals if is_interval(data) else frames).append(data)
+
+    if intervals:
+        # Registers resampled from interval files start at 0, so would be
+        # pivoted with the meter's own readings as if it had been reset
+        if frames:
+            raise ValueError(
+                "Interval files can not be combined with Daily files, "
+                "as the registers resampled from them start at 0"
+            )
+        # Overlapping downloads are merged before resampling, so the
+        # registers count each interval once
+        data = resample_intervals(
+            max_per_reading(pd.concat(intervals, ignore_index=True))
+        )
+        frames.append(compact_readings(data) if compact else data)
+
+    if not frames and since is not None:
+        # No file has readings in the window, which gives empty sheets
+        empties = (empty_readings(file) for file in files)
+        empty = next((data for data in empties if data is not None), None)
+        if empty is not None:
+            logger.warning(f"No readings since {since:%d-%m-%Y} in the files")
+            return compact_readings(empty) if compact else empty
+
+    if not frames:
+        logger.error("No data read from files")
+        raise ValueError("No data read from files")
+
+    # Concatenate once at the end, rather than copying the accumulated
+    # frame for every file
+    if compact:
+        return concat_readings(frames)
+    return pd.concat(frames)
+
+
+def concatenate_files_streaming(
+    files: list[str],
+    chunksize: int = STREAM_CHUNK_ROWS,
+    max_memory_mb: float = DEFAULT_MAX_MEMORY_MB,
+) -> DataFrame:
+    """
+    Read the files in chunks of `chunksize` rows, reducing each chunk to the
+    maximum value per date and Read Type as it is read.
+
+    The reduced chunks are buffered and concatenated once at the end. If the
+    buffer grows beyond `max_memory_mb` it is compacted into a single reduced
+    frame, so duplicate readings across files do not accumulate. If the
+    readings are larger than that once compacted, the buffer is compacted
+    again only after growing by `COMPACT_GROWTH` times, so each reading is
+    not copied again for every chunk.
+
+    Unlike `concatenate_files` the result holds only one row per reading, and
+    is not in file order.
+    """
+    ceiling = max_memory_mb * 1024 * 1024
+    limit = ceiling
+    parts = []
+    buffered = 0
+    width = None
+
+    for file in files:
+        for chunk in read_csv_chunks(file, chunksize):
+            if is_interval(chunk):
+                logger.error(f"{file} is an interval file, which can not be streamed")
+                raise ValueError("Interval files can not be streamed")
+
+            if width is None:
+                width = chunk.shape[1]
+            elif width > chunk.shape[1]:
+                logger.error(f"Data in {file} does not match columns of first file")
+
+            part = max_per_reading(chunk)
+            parts.append(part)
+            buffered += part.memory_usage(deep=True).sum()
 
-    return data1
+            if buffered > limit and len(parts) > 1:
+                parts = [max_per_reading(pd.concat(parts, ignore_index=True))]
+                buffered = parts[0].memory_usage(deep=True).sum()
+                logger.debug(
+                    f"Compacted buffered readings to {buffered / 1024 / 1024:.1f} MB"
+                )
+                if buffered > ceiling and limit == ceiling:
+                    logger.warning(
+                        f"The readings take {buffered / 1024 / 1024:.1f} MB once "
+                        f"compacted, more than the {max_memory_mb} MB ceiling"
+                    )
+                limit = max(ceiling, COMPACT_GROWTH * buffered)
 
+    if not parts:
+        logger.error("No data read from files")
+        raise ValueError("No data read from files")
 
-def main(files: list[str], days: int = 10e6):
+    return max_per_reading(pd.concat(parts, ignore_index=True))
+
+
+def build_sheets(
+    data: DataFrame, days: int, pivot: str = "numpy", metrics: dict = None
+) -> tuple[DataFrame, DataFrame]:
+    """
+    Run the pipeline on concatenated data, returning the Daily and Monthly
+    sheets with their diff columns. Each stage is timed in to `metrics`.
+    """
+    metrics = {} if metrics is None else metrics
+
+    with stage(metrics, "extract_import_entries", data.shape[0]):
+        last_n_days_data = extract_import_entries(data, days, pivot)
+
+    with stage(metrics, "add_diff_columns", last_n_days_data.shape[0]):
+        with_diff_cols = add_diff_columns(last_n_days_data)
+
+    with stage(metrics, "by_month", last_n_days_data.shape[0]):
+        monthly_data = by_month(last_n_days_data)
+
+    with stage(metrics, "add_diff_columns", monthly_data.shape[0]):
+        monthly_with_diff_cols = add_diff_columns(monthly_data, zero_to_nan=False)
+
+    return with_diff_cols, monthly_with_diff_cols
+
+
+def output_filename(mprn: str, serial: str, days: int) -> str:
+    return "%s_%s_%d_data.xlsx" % (mprn, serial, days)
+
+
+def write_workbook(
+    daily: DataFrame, monthly: DataFrame, outfile: str, backend: str = "openpyxl"
+) -> list[str]:
+    """
+    Write the Daily and Monthly sheets with one of the `export.backends`.
+    Returns the files written.
+    """
+    from export import write_sheets
+
+    return write_sheets({"Daily": daily, "Monthly": monthly}, outfile, backend)
+
+
+def incremental_readings(
+    files: list[str], days: int, store: str, backend: str = "openpyxl"
+) -> DataFrame:
+    """
+    Merge any new files in to the store, and load the readings of their meter
+    from it. Returns None if nothing changed and the spreadsheet already exists.
+    """
+    from export import output_files
+    from store import affected_months, file_meters, ingest_files, load_readings
+    from store import open_store
+
+    conn = open_store(store)
+    try:
+        changed = ingest_files(conn, files)
+
+        meters = file_meters(conn, files)
+        assert len(meters) == 1, "More than one meter in the files"
+        mprn, serial = meters.pop()
+
+        outfile = output_files(output_filename(mprn, serial, days), backend)[0]
+        if changed.empty and os.path.exists(outfile):
+            logger.info(f"No new readings. {outfile} is up to date")
+            return None
+        logger.info(f"Readings changed in months {affected_months(changed)}")
+
+        readings = load_readings(conn, mprn, serial, days)
+        if readings.empty:
+            # No stored readings in the window, which gives empty sheets
+            logger.warning(f"No readings of {mprn} in the last {days} days")
+            readings.attrs["MPRN"] = mprn
+            readings.attrs["Meter Serial Number"] = serial
+        return readings
+    finally:
+        conn.close()
+
+
+def main(
+    files: list[str],
+    days: int = 10e6,
+    stream: bool = False,
+    max_memory_mb: float = DEFAULT_MAX_MEMORY_MB,
+    store: str = None,
+    cache_dir: str = None,
+    max_cache_mb: float = None,
+    pivot: str = "numpy",
+    backend: str = "openpyxl",
+    metrics_json: str = None,
+    workers: int = None,
+    validate: bool = False,
+    fail_fast: bool = False,
+    archive: str = None,
+    scan: bool = False,
+):
     """Accept as input csv files and a number of days to extract the entries from.
     The script reads the csv files, extracts the entries from the n days,
     and saves them to an Excel file.
 
     The files can be a mix of Daily import/export files and Daily Day night peak files.
+    With `stream` the files are read in chunks bounded by `max_memory_mb`.
+
+    With `store` (the path of a SQLite file) only files not seen before are
+    read, and merged in to the readings already held in the store. The
+    spreadsheet is only rewritten if readings were added or corrected.
+
+    With `cache_dir` parsed files are cached there, limited to `max_cache_mb`.
+    With `workers` the files are parsed on that many threads.
+    With `scan` they are tokenized by `scanner.scan_csv` rather than pandas.
+
+    With `validate` the readings are checked (see `validate.validate_readings`)
+    and any anomalies written to <MPRN>_<serial>_<days>_anomalies.csv. With
+    `fail_fast` as well, errors stop the run before the spreadsheet is written.
+
+    With `archive` (the path of a Parquet dataset, see `archive.append_archive`)
+    the readings are also merged in to the archive.
+
+    `pivot` selects the pivot of `extract_import_entries`, "numpy" or "pandas".
+    `backend` selects how the sheets are written (see `export.write_sheets`).
+
+    The time, rows and peak memory of each stage are logged, and written as
+    JSON to `metrics_json` if given.
     """
 
     logger.info(f"Script started. Processing {len(files)} files...")
+    metrics = {}
 
-    data = concatenate_files(files)
+    with stage(metrics, "read") as record:
+        if store is not None:
+            data = incremental_readings(files, days, store, backend)
+        else:
+            data = concatenate_files(
+                files,
+                stream=stream,
+                max_memory_mb=max_memory_mb,
+                cache_dir=cache_dir,
+                max_cache_mb=max_cache_mb,
+                compact=not stream,
+                since=window_start(days),
+                workers=workers,
+                scan=scan,
+            )
+        record["rows"] = 0 if data is None else data.shape[0]
 
-    outfile = "output.xlsx"
-    if data is not None:
-        last_n_days_data = extract_import_entries(data, days)
+    if validate and data is not None:
+        from validate import check_readings
 
-        if last_n_days_data is not None:
-            with_diff_cols = add_diff_columns(last_n_days_data)
+        with stage(metrics, "validate", data.shape[0]):
+            data = compact_readings(data)
+            report_file = output_filename(
+                data.attrs["MPRN"], data.attrs["Meter Serial Number"], days
+            ).replace("_data.xlsx", "_anomalies.csv")
+            check_readings(data, fail_fast, report_file)
 
-            monthly_data = by_month(last_n_days_data)
-            monthly_with_diff_cols = add_diff_columns(monthly_data, zero_to_nan=False)
+    if archive is not None and data is not None:
+        from archive import append_archive
 
-            outfile = "%s_%s_%d_data.xlsx" % (
-                with_diff_cols.attrs["MPRN"],
-                with_diff_cols.attrs["Meter Serial Number"],
-                days,
-            )
+        with stage(metrics, "archive", data.shape[0]):
+            data = compact_readings(data)
+            append_archive(archive, data)
+
+    outfile = None if store is not None else "output.xlsx"
+    if data is not None:
+        with_diff_cols, monthly_with_diff_cols = build_sheets(
+            data, days, pivot, metrics
+        )
 
-            with pd.ExcelWriter(outfile) as writer:
-                with_diff_cols.to_excel(writer, sheet_name="Daily")
-                monthly_with_diff_cols.to_excel(writer, sheet_name="Monthly")
+        outfile = output_filename(
+            with_diff_cols.attrs["MPRN"],
+            with_diff_cols.attrs["Meter Serial Number"],
+            days,
+        )
+        with stage(metrics, "export", with_diff_cols.shape[0]):
+            outfile = write_workbook(
+                with_diff_cols, monthly_with_diff_cols, outfile, backend
+            )[0]
 
-    logger.info(f"Script finished. Wrote out to {outfile}")
+    log_metrics(metrics)
+    if metrics_json is not None:
+        write_metrics(metrics, metrics_json, files=files, days=days, outfile=outfile)
+
+    if outfile is not None:
+        logger.info(f"Script finished. Wrote out to {outfile}")
+    return outfile
 
 
 if __name__ == "__main__":
-    """Add command line parameters to specify the csv files and the Google Form URL."""
+    """Add command line parameters to specify the csv files and days."""
+    from export import backends
+
     parser = argparse.ArgumentParser(
-        description="Process CSV files and send data to Google Form."
+        description="Convert HDF CSV files to a spreadsheet of daily readings."
     )
     parser.add_argument("days", type=int, help="Number of days to consider", default=7)
     parser.add_argument(
         "dailyCsv", type=str, nargs="+", help="Path to the Daily CSV file"
     )
 
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the files in chunks, keeping only the maximum value per day",
+    )
+    parser.add_argument(
+        "--max-memory-mb",
+        type=float,
+        default=DEFAULT_MAX_MEMORY_MB,
+        help="Memory ceiling in MB for buffered chunks when streaming",
+    )
+
+    parser.add_argument(
+        "--store",
+        type=str,
+        default=None,
+        help="SQLite file of merged readings. Only new files are read",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache parsed files in, for faster repeat runs",
+    )
+    parser.add_argument(
+        "--max-cache-mb",
+        type=float,
+        default=None,
+        help="Size limit in MB of the cache directory (default 512)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of threads to parse the files on",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Check the readings for anomalies, writing any to a CSV report",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="With --validate, stop without a spreadsheet if there are errors",
+    )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        help="Read the files with the NumPy scanner rather than pandas",
+    )
+    parser.add_argument(
+        "--archive",
+        type=str,
+        default=None,
+        help="Also merge the readings in to a Parquet archive at this path (needs pyarrow)",
+    )
+    parser.add_argument(
+        "--latest",
+        action="store_true",
+        help="Print the latest reading of each register, rather than a spreadsheet",
+    )
+    parser.add_argument(
+        "--pivot",
+        choices=["numpy", "pandas"],
+        default="numpy",
+        help="Pivot the readings with NumPy or with pandas pivot_table",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(backends),
+        default="openpyxl",
+        help="How to write the Daily and Monthly sheets",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=str,
+        default=None,
+        help="Write the time, rows and peak memory of each stage to this JSON file",
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Profile the run, writing the profile to this file",
+    )
+    parser.add_argument(
+        "--profiler",
+        choices=["cprofile", "pyinstrument"],
+        default="cprofile",
+        help="The profiler to use with --profile",
+    )
+
     args = parser.parse_args()
 
-    main(args.dailyCsv, args.days)
+    if args.latest:
+        for read_type, (date, value) in sorted(latest_readings(args.dailyCsv).items()):
+            print(f"{read_type}: {value} at {date.strftime(hdf_date_format)}")
+        sys.exit(0)
+
+    def run():
+        return main(
+            args.dailyCsv,
+            args.days,
+            stream=args.stream,
+            max_memory_mb=args.max_memory_mb,
+            store=args.store,
+            cache_dir=args.cache_dir,
+            max_cache_mb=args.max_cache_mb,
+            pivot=args.pivot,
+            backend=args.backend,
+            metrics_json=args.metrics_json,
+            workers=args.workers,
+            validate=args.validate,
+            fail_fast=args.fail_fast,
+            archive=args.archive,
+            scan=args.scan,
+        )
+
+    if args.profile is not None:
+        profiled(run, args.profiler, args.profile)
+    else:
+        run()
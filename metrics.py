@@ -0,0 +1,99 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+
+def peak_rss_mb() -> float | None:
+    """The peak resident set size of this process so far, None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+@contextmanager
+def stage(metrics: dict, name: str, rows: int = 0):
+    """
+    Time a pipeline stage, adding its wall and CPU time, rows and the peak RSS
+    after it to `metrics[name]`. Repeated stages accumulate. The record is
+    yielded, so rows can be set once they are known.
+
+        with stage(metrics, "extract_import_entries", len(data)):
+            ...
+    """
+    record = metrics.setdefault(
+        name, {"wall_s": 0.0, "cpu_s": 0.0, "rows": 0, "calls": 0}
+    )
+    record["rows"] += rows
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_s"] += time.perf_counter() - wall
+        record["cpu_s"] += time.process_time() - cpu
+        record["calls"] += 1
+        record["peak_rss_mb"] = peak_rss_mb()
+
+
+def format_mb(mb: float | None) -> str:
+    return "unknown" if mb is None else f"{mb:.0f} MB"
+
+
+def log_metrics(metrics: dict):
+    for name, record in metrics.items():
+        throughput = ""
+        if "rows_per_s" in record:
+            throughput = f" ({record['rows_per_s']:.0f} rows/s)"
+        logger.info(
+            f"{name}: {record['wall_s']:.3f}s wall, {record['cpu_s']:.3f}s CPU, "
+            f"{record['rows']} rows{throughput}, "
+            f"peak RSS {format_mb(record['peak_rss_mb'])}"
+        )
+
+
+def write_metrics(metrics: dict, path: str, **context):
+    """Write the stage metrics as JSON, with any context such as the inputs"""
+    with open(path, "w") as f:
+        json.dump({**context, "stages": metrics}, f, indent=2, default=str)
+    logger.info(f"Wrote metrics to {path}")
+
+
+def profiled(fn, profiler: str, path: str):
+    """
+    Run `fn` under a profiler, writing the profile to `path`:
+
+    * cprofile - cProfile stats, for pstats or snakeviz
+    * pyinstrument - an HTML report (needs pyinstrument)
+    """
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+
+        profile = Profiler()
+        profile.start()
+        try:
+            return fn()
+        finally:
+            profile.stop()
+            with open(path, "w") as f:
+                f.write(profile.output_html())
+            logger.info(f"Wrote pyinstrument profile to {path}")
+
+    import cProfile
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(fn)
+    finally:
+        profile.dump_stats(path)
+        logger.info(f"Wrote cProfile stats to {path}")
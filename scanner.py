@@ -0,0 +1,230 @@
+import mmap
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from loguru import logger
+from pandas import DataFrame
+
+from main import compact_readings, read_csv
+
+# The only layout scanned. Anything else is read by pandas.
+hdf_header = b"MPRN,Meter Serial Number,Read Value,Read Type,Read Date and End Time"
+
+# "Read Date and End Time" is always DD-MM-YYYY HH:MM, so each part is at a
+# fixed offset in the field
+DATE_WIDTH = 16
+date_separators = {2: ord("-"), 5: ord("-"), 10: ord(" "), 13: ord(":")}
+
+
+def window_rows(buf: np.ndarray, starts: np.ndarray, width: int) -> np.ndarray:
+    """
+    The `width` bytes from each of `starts`, copied from a sliding window
+    view of the buffer, so no index is built per byte. Bytes past the end
+    of the buffer are zeros.
+    """
+    last = len(buf) - width
+    rows = sliding_window_view(buf, width)[np.minimum(starts, last)]
+
+    # Only the last rows of a buffer can be too close to its end for a window
+    for row in np.flatnonzero(starts > last):
+        tail = buf[slice(starts[row], None)]
+        rows[row] = 0
+        rows[row, slice(len(tail))] = tail
+    return rows
+
+
+def field_matrix(buf: np.ndarray, starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """
+    The bytes of one field of every row, as a row per field padded with
+    zeros to the widest, rounded up to 8 bytes
+    """
+    lengths = stops - starts
+    width = -(-int(lengths.max()) // 8) * 8
+    fields = window_rows(buf, starts, width)
+    fields *= np.arange(width) < lengths[:, None]
+    return fields
+
+
+def factorize_fields(fields: np.ndarray) -> tuple[list[str], np.ndarray] | None:
+    """
+    The distinct values of a field matrix, sorted, and the code of each row.
+    Rows are hashed 8 bytes at a time and factorized by the hashes, which are
+    then checked against the rows. Returns None on a collision, or values
+    that are not UTF-8.
+    """
+    chunks = fields.view(np.uint64)
+    hashes = np.zeros(len(fields), dtype=np.uint64)
+    for column in range(chunks.shape[1]):
+        hashes = hashes * np.uint64(1099511628211) + chunks[:, column]
+    codes, _ = pd.factorize(hashes)
+
+    # The first row of each code, as the lowest index written last
+    first = np.empty(codes.max() + 1, dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes) - 1, -1, -1)
+    if not (fields == fields[first][codes]).all():
+        return None
+
+    try:
+        values = [bytes(fields[row]).rstrip(b"\0").decode() for row in first]
+    except UnicodeDecodeError:
+        return None
+    order = np.argsort(values)
+    sorted_codes = np.empty_like(order)
+    sorted_codes[order] = np.arange(len(order))
+    return [values[i] for i in order], sorted_codes[codes].astype(np.int32)
+
+
+def same_fields(fields: np.ndarray) -> str | None:
+    """
+    The value of a field matrix whose rows are all the same, else None, as
+    for a value that is not UTF-8
+    """
+    if not (fields == fields[0]).all():
+        return None
+    try:
+        return bytes(fields[0]).rstrip(b"\0").decode()
+    except UnicodeDecodeError:
+        return None
+
+
+def parse_values(fields: np.ndarray) -> np.ndarray | None:
+    """
+    Parse a field matrix of numbers, e.g. 34640.640, to float64 with NumPy's
+    bytes to float cast, which parses in C. Empty fields are NaN. Returns
+    None if any field is not a number.
+    """
+    values = np.full(len(fields), np.nan)
+    filled = fields[:, 0] != 0
+    try:
+        values[filled] = (
+            fields[filled].view(f"S{fields.shape[1]}").ravel().astype(float)
+        )
+    except ValueError:
+        return None
+    return values
+
+
+def parse_days(fields: np.ndarray) -> np.ndarray | None:
+    """
+    Parse rows of DD-MM-YYYY HH:MM dates to int32 days since 1970-01-01.
+    Returns None if any is not such a date.
+    """
+    for offset, separator in date_separators.items():
+        if (fields[:, offset] != separator).any():
+            return None
+    digit_columns = [c for c in range(DATE_WIDTH) if c not in date_separators]
+    digits = fields[:, digit_columns] - np.uint8(ord("0"))
+    if (digits > 9).any():
+        return None
+
+    digits = digits.astype(np.int32)
+    day = digits[:, 0] * 10 + digits[:, 1]
+    month = digits[:, 2] * 10 + digits[:, 3]
+    year = digits[:, 4] * 1000 + digits[:, 5] * 100 + digits[:, 6] * 10 + digits[:, 7]
+    if (month < 1).any() or (month > 12).any() or (day < 1).any():
+        return None
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    days = months.astype("datetime64[D]") + (day - 1)
+    # Days past the end of their month, e.g. 31-02, land in the next one
+    if (days.astype("datetime64[M]") != months).any():
+        return None
+    return days.astype(np.int32)
+
+
+def scan_buffer(buf: np.ndarray) -> DataFrame | None:
+    """
+    Tokenize the bytes of a HDF file in to compact readings (see
+    `main.compact_readings`) with NumPy byte operations, without a Python
+    object per row. Only Read Type and the meter's ids are decoded, once per
+    distinct value.
+
+    Returns None for anything but the plain HDF layout of one meter: another
+    header, quoted fields, other than 5 fields a row, interval readings, or
+    values and dates not in the usual format.
+    """
+    newlines = np.flatnonzero(buf == ord("\n"))
+    if len(newlines) == 0:
+        return None
+    header = bytes(buf[: newlines[0]]).rstrip(b"\r").removeprefix(b"\xef\xbb\xbf")
+    if header != hdf_header or (buf == ord('"')).any():
+        return None
+
+    # The start and end of each line, without its \r\n, skipping blank lines
+    starts = newlines + 1
+    stops = np.r_[newlines[1:], len(buf)]
+    stops = stops - ((stops > starts) & (buf[np.maximum(stops - 1, 0)] == ord("\r")))
+    keep = stops > starts
+    starts, stops = starts[keep], stops[keep]
+    if len(starts) == 0:
+        return None
+
+    commas = np.flatnonzero(buf == ord(","))
+    commas = commas[commas > newlines[0]]
+    if len(commas) != 4 * len(starts):
+        return None
+    commas = commas.reshape(-1, 4)
+    if (commas[:, 0] < starts).any() or (commas[:, 3] >= stops).any():
+        return None
+
+    factorized = factorize_fields(field_matrix(buf, commas[:, 2] + 1, commas[:, 3]))
+    if factorized is None:
+        return None
+    read_types, codes = factorized
+    if any(" Interval " in read_type for read_type in read_types):
+        return None
+    # The MPRN and Meter Serial Number of every row are the same
+    meter = same_fields(field_matrix(buf, starts, commas[:, 1]))
+    if meter is None:
+        return None
+    mprn, serial = meter.split(",")
+
+    values = parse_values(field_matrix(buf, commas[:, 1] + 1, commas[:, 2]))
+    if (stops - commas[:, 3] - 1 != DATE_WIDTH).any():
+        return None
+    days = parse_days(window_rows(buf, commas[:, 3] + 1, DATE_WIDTH))
+    if values is None or days is None:
+        return None
+
+    readings = DataFrame(
+        {
+            "Read Value": values,
+            "Read Type": pd.Categorical.from_codes(codes, read_types),
+            "day": days,
+        }
+    )
+    readings.attrs["MPRN"] = mprn
+    readings.attrs["Meter Serial Number"] = serial
+    return readings
+
+
+def scan_csv(file_path: str, since: datetime = None) -> DataFrame | None:
+    """
+    Read a HDF file in to compact readings, memory mapping it and tokenizing
+    it with `scan_buffer`. Files it does not expect are read with `read_csv`
+    instead: compacted, or in the HDF layout for interval files, which
+    `concatenate_files` resamples. With `since` only the readings from that
+    day on are kept.
+    """
+    readings = None
+    try:
+        with open(file_path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped:
+            readings = scan_buffer(np.frombuffer(mapped, dtype=np.uint8))
+    except ValueError as e:
+        # Empty files cannot be mapped
+        logger.debug(f"Could not map {file_path}: {e}")
+
+    if readings is None:
+        logger.debug(f"{file_path} is not in the plain HDF layout. Using pandas")
+        data = read_csv(file_path)
+        if data is None or data.empty or " Interval " in data["Read Type"].iloc[0]:
+            return data
+        readings = compact_readings(data)
+
+    if since is not None:
+        start = np.datetime64(since, "D").astype(np.int64)
+        readings = readings[readings["day"] >= start].reset_index(drop=True)
+    return readings
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import date
+from email.parser import BytesParser
+from email.policy import HTTP
+from functools import partial
+from urllib.parse import parse_qs, urlsplit
+
+from loguru import logger
+
+from main import (
+    build_sheets,
+    concatenate_files,
+    output_filename,
+    window_start,
+    write_workbook,
+)
+
+DEFAULT_PORT = 8080
+MAX_UPLOAD_MB = 50
+CACHE_ENTRIES = 64
+
+# The formats a conversion can be returned in, and their content types
+formats = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "json": "application/json",
+}
+
+reasons = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_uploads(content_type: str, body: bytes) -> list[bytes]:
+    """
+    The CSV files of a request body: each part of a multipart/form-data body,
+    or the whole body otherwise.
+    """
+    if not content_type.startswith("multipart/"):
+        return [body] if body else []
+
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    if not message.is_multipart():
+        raise HTTPError(400, "Malformed multipart body")
+    return [part.get_payload(decode=True) for part in message.iter_parts()]
+
+
+def convert(uploads: list[bytes], days: int, output_format: str) -> tuple[str, bytes]:
+    """
+    Run the pipeline on uploaded HDF files, in a worker process.
+
+    :return: the file name and content of the Daily and Monthly sheets, as an
+        xlsx workbook or JSON
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i, upload in enumerate(uploads):
+            files.append(os.path.join(tmp, f"upload_{i}.csv"))
+            with open(files[-1], "wb") as f:
+                f.write(upload)
+
+        data = concatenate_files(files, compact=True, since=window_start(days))
+        daily, monthly = build_sheets(data, days)
+        outfile = output_filename(
+            daily.attrs["MPRN"], daily.attrs["Meter Serial Number"], days
+        )
+
+        if output_format == "json":
+            content = {
+                "MPRN": daily.attrs["MPRN"],
+                "Meter Serial Number": daily.attrs["Meter Serial Number"],
+                "days": days,
+                "Daily": json.loads(daily.to_json(orient="split")),
+                "Monthly": json.loads(monthly.to_json(orient="split")),
+            }
+            return outfile.replace(".xlsx", ".json"), json.dumps(content).encode()
+
+        path = write_workbook(daily, monthly, os.path.join(tmp, outfile))[0]
+        with open(path, "rb") as f:
+            return outfile, f.read()
+
+
+def cache_key(uploads: list[bytes], days: int, output_format: str) -> str:
+    """
+    A key for the uploaded files, in any order, and the options. The date is
+    included, as the days window moves with it.
+    """
+    hashes = sorted(hashlib.sha256(upload).hexdigest() for upload in uploads)
+    key = "|".join(hashes + [str(days), output_format, date.today().isoformat()])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, dict, bytes]:
+    """Read the method, target, headers and body of a HTTP request"""
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    try:
+        method, target, _ = request_line.split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    body = b""
+    if method == "POST":
+        if "content-length" not in headers:
+            raise HTTPError(411, "Content-Length is required")
+        try:
+            length = int(headers["content-length"])
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HTTPError(400, "Content-Length must be a non-negative integer")
+        if length > MAX_UPLOAD_MB * 1024 * 1024:
+            raise HTTPError(413, f"Uploads are limited to {MAX_UPLOAD_MB} MB")
+        body = await reader.readexactly(length)
+
+    return method, target, headers, body
+
+
+async def respond(
+    writer: asyncio.StreamWriter,
+    status: int,
+    content: bytes,
+    content_type: str = "text/plain",
+    filename: str = None,
+):
+    headers = [
+        f"HTTP/1.1 {status} {reasons[status]}",
+        f"Content-Type: {content_type}",
+        f"Content-Length: {len(content)}",
+        "Connection: close",
+    ]
+    if filename is not None:
+        headers.append(f'Content-Disposition: attachment; filename="{filename}"')
+    writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + content)
+    await writer.drain()
+
+
+async def handle(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    executor: Executor,
+    cache: OrderedDict,
+):
+    """
+    Handle one request:
+
+    * GET /health - 200 if the server is up
+    * POST /convert?days=N&format=xlsx|json - the sheets of the uploaded files
+
+    Conversions run on `executor`. They are cached by the hashes of the
+    uploaded files, and concurrent requests for the same files share one.
+    """
+    try:
+        method, target, headers, body = await read_request(reader)
+        url = urlsplit(target)
+        logger.debug(f"{method} {target}")
+
+        if url.path == "/health":
+            await respond(writer, 200, b"ok")
+            return
+        if url.path != "/convert":
+            raise HTTPError(404, f"No such path {url.path}")
+        if method != "POST":
+            raise HTTPError(405, "Use POST to convert files")
+
+        query = parse_qs(url.query)
+        try:
+            days = int(query.get("days", ["7"])[0])
+        except ValueError:
+            raise HTTPError(400, "days must be an integer")
+        output_format = query.get("format", ["xlsx"])[0]
+        if output_format not in formats:
+            raise HTTPError(400, f"format must be one of {', '.join(formats)}")
+
+        uploads = parse_uploads(headers.get("content-type", ""), body)
+        if not uploads:
+            raise HTTPError(400, "No files uploaded")
+
+        key = cache_key(uploads, days, output_format)
+        if key in cache:
+            cache.move_to_end(key)
+            logger.info(f"Serving {len(uploads)} files from cache")
+        else:
+            loop = asyncio.get_running_loop()
+            cache[key] = loop.run_in_executor(
+                executor, convert, uploads, days, output_format
+            )
+            while len(cache) > CACHE_ENTRIES:
+                cache.popitem(last=False)
+        conversion = cache[key]
+
+        try:
+            filename, content = await asyncio.shield(conversion)
+        except Exception as e:
+            cache.pop(key, None)
+            raise HTTPError(400, f"Could not convert the files: {e}")
+
+        await respond(writer, 200, content, formats[output_format], filename)
+    except HTTPError as e:
+        logger.warning(f"{e.status}: {e}")
+        await respond(writer, e.status, str(e).encode())
+    except Exception as e:
+        logger.error(f"Error handling request: {e}")
+        await respond(writer, 500, b"Internal error")
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def start_server(
+    host: str, port: int, executor: Executor, cache: OrderedDict = None
+) -> asyncio.Server:
+    """Start serving conversions on `host` and `port`"""
+    cache = OrderedDict() if cache is None else cache
+    server = await asyncio.start_server(
+        partial(handle, executor=executor, cache=cache), host, port
+    )
+    logger.info(
+        f"Listening on {', '.join(str(s.getsockname()) for s in server.sockets)}"
+    )
+    return server
+
+
+def serve(host: str = "127.0.0.1", port: int = DEFAULT_PORT, workers: int = None):
+    """Serve until interrupted, converting on a pool of `workers` processes"""
+
+    async def run():
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            server = await start_server(host, port, executor)
+            async with server:
+                await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        logger.info("Server stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve an HTTP API converting uploaded HDF files to spreadsheets."
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to bind")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to bind")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: one per CPU)",
+    )
+
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers)
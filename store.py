@@ -0,0 +1,208 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import pandas as pd
+from loguru import logger
+from pandas import DataFrame
+
+from main import (
+    hdf_date_format,
+    is_interval,
+    parse_read_dates,
+    read_csv,
+    window_start,
+)
+
+# Readings are kept with ISO dates so they sort and filter in SQL. They are
+# converted back to the HDF date format when loaded.
+schema = """
+CREATE TABLE IF NOT EXISTS readings (
+    mprn TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    read_type TEXT NOT NULL,
+    read_date TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (mprn, serial, read_type, read_date)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    mprn TEXT,
+    serial TEXT,
+    rows INTEGER,
+    ingested TEXT
+);
+"""
+
+iso_date_format = "%Y-%m-%d %H:%M"
+
+
+def open_store(path: str) -> sqlite3.Connection:
+    """Open (creating if needed) the SQLite store of merged readings"""
+    conn = sqlite3.connect(path)
+    conn.executescript(schema)
+    return conn
+
+
+def new_files(conn: sqlite3.Connection, files: list[str]) -> list[str]:
+    """
+    The files that have not been ingested before, or have changed size or
+    modification time since they were.
+    """
+    result = []
+    for file in files:
+        stat = os.stat(file)
+        row = conn.execute(
+            "SELECT size, mtime_ns FROM files WHERE path = ?", (os.path.abspath(file),)
+        ).fetchone()
+        if row != (stat.st_size, stat.st_mtime_ns):
+            result.append(file)
+    return result
+
+
+def file_meters(conn: sqlite3.Connection, files: list[str]) -> set[tuple[str, str]]:
+    """The (MPRN, Meter Serial Number) pairs recorded for ingested files"""
+    meters = set()
+    for file in files:
+        row = conn.execute(
+            "SELECT mprn, serial FROM files WHERE path = ?", (os.path.abspath(file),)
+        ).fetchone()
+        if row is not None:
+            meters.add(row)
+    return meters
+
+
+def ingest_files(conn: sqlite3.Connection, files: list[str]) -> DataFrame:
+    """
+    Merge the readings of any new or changed files in to the store.
+    Where a reading already exists the maximum value wins, as a later HDF
+    file may correct an earlier one.
+
+    :return: the readings that were added or increased, in the HDF layout
+    """
+    changed = []
+    for file in new_files(conn, files):
+        data = read_csv(file)
+        if data is None:
+            continue
+        if data.empty:
+            logger.warning(f"{file} has no readings")
+            continue
+        if is_interval(data):
+            logger.error(f"{file} is an interval file, which can not be stored")
+            continue
+
+        incoming = DataFrame(
+            {
+                "mprn": data["MPRN"],
+                "serial": data["Meter Serial Number"],
+                "read_type": data["Read Type"],
+                "read_date": parse_read_dates(
+                    data["Read Date and End Time"]
+                ).dt.strftime(iso_date_format),
+                "value": data["Read Value"],
+            }
+        )
+
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS temp.incoming")
+            conn.execute(
+                "CREATE TEMP TABLE incoming (mprn, serial, read_type, read_date, value)"
+            )
+            conn.executemany(
+                "INSERT INTO temp.incoming VALUES (?, ?, ?, ?, ?)",
+                incoming.itertuples(index=False, name=None),
+            )
+            updates = pd.read_sql_query(
+                """
+                SELECT i.mprn, i.serial, i.read_type, i.read_date, max(i.value) AS value
+                FROM temp.incoming AS i
+                LEFT JOIN readings AS r USING (mprn, serial, read_type, read_date)
+                GROUP BY i.mprn, i.serial, i.read_type, i.read_date
+                HAVING max(r.read_date) IS NULL OR max(i.value) > max(r.value)
+                    OR (max(r.value) IS NULL AND max(i.value) IS NOT NULL)
+                """,
+                conn,
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO readings VALUES (?, ?, ?, ?, ?)",
+                updates.itertuples(index=False, name=None),
+            )
+
+            stat = os.stat(file)
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    os.path.abspath(file),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    data["MPRN"].iloc[0],
+                    data["Meter Serial Number"].iloc[0],
+                    data.shape[0],
+                    datetime.now().isoformat(timespec="seconds"),
+                ),
+            )
+
+        logger.info(f"Ingested {file}: {len(updates)} of {data.shape[0]} rows changed")
+        changed.append(updates)
+
+    if not changed:
+        return DataFrame(
+            columns=[
+                "MPRN",
+                "Meter Serial Number",
+                "Read Value",
+                "Read Type",
+                "Read Date and End Time",
+            ]
+        )
+
+    return to_hdf_layout(pd.concat(changed, ignore_index=True))
+
+
+def load_readings(
+    conn: sqlite3.Connection, mprn: str, serial: str, days: int = None
+) -> DataFrame:
+    """
+    Load the merged readings of one meter in the HDF layout expected by
+    `extract_import_entries`, optionally only those from the last `days` days.
+    """
+    since = ""
+    if days is not None:
+        # As iso_date_format, with the year padded to 4 digits even before 1000
+        since = window_start(days).isoformat(sep=" ", timespec="minutes")
+
+    readings = pd.read_sql_query(
+        """
+        SELECT mprn, serial, read_type, read_date, value FROM readings
+        WHERE mprn = ? AND serial = ? AND read_date >= ?
+        ORDER BY read_date DESC, read_type
+        """,
+        conn,
+        params=(mprn, serial, since),
+    )
+    return to_hdf_layout(readings)
+
+
+def to_hdf_layout(readings: DataFrame) -> DataFrame:
+    """Convert rows of the readings table to the columns of a HDF file"""
+    return DataFrame(
+        {
+            "MPRN": readings["mprn"],
+            "Meter Serial Number": readings["serial"],
+            "Read Value": readings["value"].astype(float),
+            "Read Type": readings["read_type"],
+            "Read Date and End Time": pd.to_datetime(
+                readings["read_date"], format=iso_date_format
+            ).dt.strftime(hdf_date_format),
+        }
+    )
+
+
+def affected_months(changed: DataFrame) -> list[str]:
+    """The year-month of each changed reading, e.g. 2024-12"""
+    dates = pd.to_datetime(changed["Read Date and End Time"], format=hdf_date_format)
+    return sorted(dates.dt.strftime("%Y-%m").unique())
@@ -0,0 +1,254 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+import requests
+from loguru import logger
+from pandas import DataFrame
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from main import build_sheets, concatenate_files, window_start
+
+BATCH_SIZE = 50
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 5
+LEDGER_FILE = "submitted.sqlite"
+
+ledger_schema = """
+CREATE TABLE IF NOT EXISTS submitted (
+    key TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    sent TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def daily_rows(data: DataFrame) -> list[dict]:
+    """
+    One row per day of a Daily sheet (the output of `extract_import_entries`,
+    with or without diff columns), oldest first, with a value per Read Type.
+    Days without any value are left out.
+    """
+    rows = []
+    for year in sorted(data.columns.get_level_values(1).unique()):
+        by_year = data.xs(year, axis=1, level=1)
+        values = by_year.to_numpy(dtype=float)
+        for month_day, cells in zip(by_year.index, values):
+            present = ~np.isnan(cells)
+            if not present.any():
+                continue
+            row = {
+                "MPRN": data.attrs["MPRN"],
+                "Meter Serial Number": data.attrs["Meter Serial Number"],
+                "date": f"{year}-{month_day}",
+            }
+            row.update(zip(by_year.columns[present], cells[present].tolist()))
+            rows.append(row)
+    return rows
+
+
+def row_key(row: dict) -> str:
+    return f"{row['MPRN']}|{row['Meter Serial Number']}|{row['date']}"
+
+
+def row_digest(row: dict) -> str:
+    return hashlib.sha256(json.dumps(row, sort_keys=True).encode()).hexdigest()
+
+
+def open_ledger(path: str) -> sqlite3.Connection:
+    """Open (creating if needed) the ledger of rows already submitted"""
+    conn = sqlite3.connect(path)
+    conn.executescript(ledger_schema)
+    return conn
+
+
+def unsent(conn: sqlite3.Connection, rows: list[dict]) -> list[dict]:
+    """
+    The rows not submitted before, or whose values have changed since, as
+    when a later HDF file corrects a day.
+    """
+    sent = dict(conn.execute("SELECT key, digest FROM submitted"))
+    return [row for row in rows if sent.get(row_key(row)) != row_digest(row)]
+
+
+def record_sent(conn: sqlite3.Connection, rows: list[dict]):
+    sent = datetime.now().isoformat(timespec="seconds")
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO submitted VALUES (?, ?, ?)",
+            [(row_key(row), row_digest(row), sent) for row in rows],
+        )
+
+
+def make_session(
+    workers: int = DEFAULT_WORKERS,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = 0.5,
+    idempotent: bool = True,
+) -> requests.Session:
+    """
+    A session pooling up to `workers` connections, retrying connection errors
+    and 429 or 5xx responses with exponential backoff.
+
+    :param idempotent: whether the server drops repeated posts, as a webhook
+        given the Idempotency-Key does. Otherwise, as for form submissions,
+        only posts the server can not have accepted are retried: connection
+        errors and 429 or 503 responses, but not read timeouts.
+    """
+    retry = Retry(
+        total=retries,
+        read=None if idempotent else 0,
+        backoff_factor=backoff,
+        status_forcelist=[429, 500, 502, 503, 504] if idempotent else [429, 503],
+        allowed_methods=["POST"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=workers, pool_maxsize=workers, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def post_batch(
+    session: requests.Session, url: str, batch: list[dict], fields: dict = None
+):
+    """
+    Post a batch of rows: as one JSON list to a webhook, or, given the form
+    `fields` for each row value (e.g. {"date": "entry.123"}), as one form
+    submission per row, as a Google Form takes one response at a time.
+    """
+    keys = "|".join(row_key(row) for row in batch)
+    headers = {"Idempotency-Key": hashlib.sha256(keys.encode()).hexdigest()}
+
+    if fields is None:
+        responses = [session.post(url, json=batch, headers=headers, timeout=30)]
+    else:
+        responses = [
+            session.post(
+                url,
+                data={
+                    field: row[name] for name, field in fields.items() if name in row
+                },
+                timeout=30,
+            )
+            for row in batch
+        ]
+    for response in responses:
+        response.raise_for_status()
+
+
+def submit_rows(
+    rows: list[dict],
+    url: str,
+    ledger: str = LEDGER_FILE,
+    fields: dict = None,
+    batch_size: int = BATCH_SIZE,
+    workers: int = DEFAULT_WORKERS,
+    session: requests.Session = None,
+) -> int:
+    """
+    Submit the rows not already in the `ledger` to `url`, in batches of
+    `batch_size` posted by up to `workers` threads on one pooled session.
+    Each batch is recorded in the ledger once it is accepted, so a failed or
+    interrupted run can be repeated without sending days twice.
+
+    :param fields: post each row as a form submission with these fields (see
+        `post_batch`), rather than batches of JSON
+    :return: the number of rows submitted
+    """
+    if fields is not None:
+        batch_size = 1
+
+    conn = open_ledger(ledger)
+    own_session = session is None
+    if own_session:
+        # Form submissions have no idempotency key
+        session = make_session(workers, idempotent=fields is None)
+    try:
+        pending = unsent(conn, rows)
+        logger.info(f"Submitting {len(pending)} of {len(rows)} days to {url}")
+
+        batches = []
+        for row in pending:
+            if not batches or len(batches[-1]) == batch_size:
+                batches.append([])
+            batches[-1].append(row)
+        submitted = 0
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(post_batch, session, url, batch, fields): batch
+                for batch in batches
+            }
+            # The ledger is only written from this thread
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Failed to submit {len(batch)} days: {e}")
+                    failed += len(batch)
+                    continue
+                record_sent(conn, batch)
+                submitted += len(batch)
+
+        if failed:
+            logger.warning(f"{failed} days not submitted. Run again to retry them")
+        return submitted
+    finally:
+        if own_session:
+            session.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Submit the daily readings of HDF files to a form or webhook."
+    )
+    parser.add_argument("days", type=int, help="Number of days to consider", default=7)
+    parser.add_argument(
+        "dailyCsv", type=str, nargs="+", help="Path to the Daily CSV file"
+    )
+    parser.add_argument("--url", type=str, required=True, help="URL to post to")
+    parser.add_argument(
+        "--fields",
+        type=str,
+        default=None,
+        help='JSON of form fields per value, e.g. {"date": "entry.123"}',
+    )
+    parser.add_argument(
+        "--ledger",
+        type=str,
+        default=LEDGER_FILE,
+        help="SQLite file recording the days already submitted",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=BATCH_SIZE, help="Days per JSON post"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of posts in flight at once",
+    )
+
+    args = parser.parse_args()
+
+    data = concatenate_files(args.dailyCsv, compact=True, since=window_start(args.days))
+    daily, _ = build_sheets(data, args.days)
+    submit_rows(
+        daily_rows(daily),
+        args.url,
+        ledger=args.ledger,
+        fields=None if args.fields is None else json.loads(args.fields),
+        batch_size=args.batch_size,
+        workers=args.workers,
+    )
@@ -1,11 +1,48 @@
-import numpy as np
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
 
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+from loguru import logger
+
+from batch import group_by_meter, run_batch
+from benchmark import bench_pipeline, generate_hdf_files
+from cache import read_cached_csv
+from daemon import evict_idle, update_meters, watch
+from export import write_sheets
+from fleet import fleet_report, meter_aggregates, sketch_buckets, sketch_quantile
+from scanner import scan_csv
+from server import start_server
+from submit import daily_rows, make_session, submit_rows
+from validate import check_readings, validate_readings
+from store import ingest_files, load_readings, open_store
 from main import (
     main,
+    build_sheets,
     by_month,
+    compact_readings,
+    month_names,
+    latest_readings,
+    outside_window,
+    tail_read_date,
+    output_filename,
     concatenate_files,
     extract_import_entries,
     add_diff_columns,
+    parse_read_dates,
+    read_csv,
 )
 
 MPRN = "MPRN"
@@ -37,6 +74,202 @@ def test_main():
     )
 
 
+def test_main_empty_window(tmp_path, monkeypatch):
+    """Files with no readings in the window give a workbook with empty sheets"""
+    files = [
+        os.path.abspath("test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv"),
+        os.path.abspath("test/HDF_Daily_kWh_01234567890_26-12-2024.csv"),
+    ]
+    monkeypatch.chdir(tmp_path)
+    store = str(tmp_path / "readings.sqlite")
+    for options in [{}, {"stream": True}, {"scan": True}, {"workers": 2}]:
+        main(files, 0, **options)
+        sheets = pd.read_excel(
+            output_filename("01234567890", "000000000087654321", 0),
+            sheet_name=None,
+            index_col=0,
+        )
+        assert sheets["Daily"].dropna(how="all").empty
+        assert sheets["Monthly"].dropna(how="all").empty
+        os.remove(output_filename("01234567890", "000000000087654321", 0))
+
+    # The stored readings have none in the window either
+    main(files, 0, store=store)
+    assert os.path.exists(output_filename("01234567890", "000000000087654321", 0))
+
+
+def test_main_metrics(tmp_path, monkeypatch):
+    """Each stage is written to the metrics JSON"""
+    files = [
+        os.path.abspath("test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv"),
+        os.path.abspath("test/HDF_Daily_kWh_01234567890_20-12-2024.csv"),
+    ]
+    monkeypatch.chdir(tmp_path)
+    main(files, 10000, metrics_json="metrics.json")
+
+    metrics = json.loads((tmp_path / "metrics.json").read_text())
+    assert metrics["days"] == 10000
+    assert list(metrics["stages"]) == [
+        "read",
+        "extract_import_entries",
+        "add_diff_columns",
+        "by_month",
+        "export",
+    ]
+    assert metrics["stages"]["read"]["rows"] == 3358
+    assert metrics["stages"]["add_diff_columns"]["calls"] == 2
+    assert metrics["stages"]["export"]["wall_s"] > 0
+
+    # Without the resource module, as on Windows, the peak RSS is unknown
+    import metrics as metrics_module
+
+    monkeypatch.setattr(metrics_module, "resource", None)
+    main(files, 10000, metrics_json="metrics.json")
+    metrics = json.loads((tmp_path / "metrics.json").read_text())
+    assert metrics["stages"]["read"]["peak_rss_mb"] is None
+
+
+def test_main_workers_read_with_arrow(tmp_path, monkeypatch):
+    """With workers, main reads the files with the pyarrow reader"""
+    import main as main_module
+
+    files = [
+        os.path.abspath("test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv"),
+        os.path.abspath("test/HDF_Daily_kWh_01234567890_20-12-2024.csv"),
+    ]
+    read = []
+
+    def read_csv_arrow(file_path):
+        read.append(file_path)
+        return main_module.read_csv(file_path)
+
+    monkeypatch.setattr(main_module, "read_csv_arrow", read_csv_arrow)
+    monkeypatch.chdir(tmp_path)
+    main(files, 10000, metrics_json="metrics.json", workers=2)
+
+    assert sorted(read) == sorted(files)
+    metrics = json.loads((tmp_path / "metrics.json").read_text())
+    assert metrics["stages"]["read"]["rows"] == 3358
+
+
+def test_concatenate_window():
+    """Only readings in the window are read, and older files are skipped"""
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    full = concatenate_files(files)
+    full_dates = parse_read_dates(full[READ_DATE_AND_END_TIME])
+
+    since = datetime(2024, 6, 1)
+    windowed = concatenate_files(files, since=since)
+    pd.testing.assert_frame_equal(windowed, full[(full_dates >= since).to_numpy()])
+
+    # Downloaded before the window, by the filename date
+    assert outside_window(files[0], datetime(2024, 12, 21))
+    assert not outside_window(files[2], datetime(2024, 12, 21))
+    windowed = concatenate_files(files, since=datetime(2024, 12, 21))
+    assert windowed.shape[0] == 12
+    assert (parse_read_dates(windowed[READ_DATE_AND_END_TIME]) >= "2024-12-21").all()
+
+    # A window after the newest reading has none, but keeps the meter
+    empty = concatenate_files(files, since=datetime(2025, 1, 1))
+    assert empty.empty and list(empty.columns) == list(full.columns)
+    assert empty.attrs["MPRN"] == "01234567890"
+    empty = concatenate_files(files, compact=True, since=datetime(2025, 1, 1))
+    assert empty.empty and empty.attrs["Meter Serial Number"] == "000000000087654321"
+
+    # Windows before the oldest reading read the files whole
+    assert tail_read_date(files[1]) == datetime(2022, 12, 20)
+    pd.testing.assert_frame_equal(concatenate_files(files, since=datetime.min), full)
+    pd.testing.assert_frame_equal(
+        concatenate_files(files, since=datetime(2020, 1, 1)), full
+    )
+
+
+def test_concatenate_parallel():
+    """Parsing on a thread pool gives the same frame, in file order"""
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    for options in ({}, {"compact": True}, {"since": datetime(2024, 6, 1)}):
+        pd.testing.assert_frame_equal(
+            concatenate_files(files, workers=3, **options),
+            concatenate_files(files, **options),
+        )
+
+
+def test_concatenate_parallel_fresh_process():
+    """
+    Threads do not race to load the lazily imported pandas, which is only
+    loaded on first use in a fresh process
+    """
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    script = (
+        "import sys; from main import concatenate_files; "
+        "print(len(concatenate_files(sys.argv[1:], workers=3)))"
+    )
+    for _ in range(3):
+        result = subprocess.run(
+            [sys.executable, "-c", script, *files],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert result.stdout.strip() == "3376"
+        assert "ERROR" not in result.stderr
+
+
+def test_resample_intervals():
+    """30 minute kW readings are resampled to daily Day/Night/Peak registers"""
+    df = concatenate_files(["test/interval/HDF_kW_01234567890_20-12-2024.csv"])
+    assert df.shape == (20, 5)
+    assert set(df[READ_DATE_AND_END_TIME]) == {
+        "17-12-2024 00:00",
+        "18-12-2024 00:00",
+        "19-12-2024 00:00",
+        "20-12-2024 00:00",
+    }
+
+    reduced_df = extract_import_entries(df, 10000)
+    daily = add_diff_columns(reduced_df).loc["12-18"]
+    # 1 kW all day, and 0.2 kW exported from 10:00 to 16:00
+    assert daily[("Night Import Register (kWh)_diff", 2024)] == 9
+    assert daily[("Day Off-Peak Import Register (kWh)_diff", 2024)] == 13
+    assert daily[("Day Peak Import Register (kWh)_diff", 2024)] == 2
+    assert daily[("24 Hr Active Import Register (kWh)_diff", 2024)] == 24
+    assert daily[("24 Hr Active Export Register (kWh)_diff", 2024)] == pytest.approx(
+        1.2
+    )
+    assert reduced_df.loc["12-20", ("24 Hr Active Import Register (kWh)", 2024)] == 72
+
+    # A repeated download counts each interval once
+    pd.testing.assert_frame_equal(
+        concatenate_files(["test/interval/HDF_kW_01234567890_20-12-2024.csv"] * 2), df
+    )
+
+
+def test_intervals_with_daily_files():
+    """Interval files are not merged with Daily files, whose registers they break"""
+    daily = "test/HDF_Daily_kWh_01234567890_20-12-2024.csv"
+    interval = "test/interval/HDF_kW_01234567890_20-12-2024.csv"
+    with pytest.raises(ValueError, match="Interval files"):
+        concatenate_files([daily, interval])
+
+    # Batch and fleet runs leave the interval files of such a meter out
+    assert group_by_meter([daily, interval]) == {
+        ("01234567890", "000000000087654321"): [daily]
+    }
+    assert list(group_by_meter([interval]).values()) == [[interval]]
+
+
 def test_concatenate_2_files():
     df = concatenate_files(
         [
@@ -210,6 +443,87 @@ def test_concatenate_3_file():
     assert export_row_18th[READ_VALUE] == 5448.501
 
 
+def test_concatenate_3_files_streaming():
+    """Streaming keeps only the maximum value of each reading"""
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+
+    # Small chunks and a tiny memory ceiling to force compaction
+    df = concatenate_files(files, stream=True, chunksize=500, max_memory_mb=0.01)
+
+    assert df is not None
+    assert df.shape[0] == 3376 - 4  # 18th and 19th import/export are repeated
+    assert list(df.columns) == [
+        MPRN,
+        METER_SERIAL_NUMBER,
+        READ_VALUE,
+        READ_TYPE,
+        READ_DATE_AND_END_TIME,
+    ]
+
+    import_18th = df[
+        (df[READ_TYPE] == TWENTYFOUR_HR_ACTIVE_IMPORT_REGISTER)
+        & (df[READ_DATE_AND_END_TIME] == "18-12-2024 00:00")
+    ]
+    assert import_18th[READ_VALUE].tolist() == [34400.0]
+
+    # Over the ceiling, the buffer is compacted as it doubles rather than
+    # for each of the 34 chunks, and the ceiling is warned about once
+    messages = []
+    handler = logger.add(messages.append, level="DEBUG", format="{level} {message}")
+    try:
+        concatenate_files(files, stream=True, chunksize=100, max_memory_mb=0.01)
+    finally:
+        logger.remove(handler)
+    assert sum("Compacted" in message for message in messages) < 10
+    assert sum(message.startswith("WARNING") for message in messages) == 1
+
+    streamed = extract_import_entries(df, 10000)
+    expected = extract_import_entries(concatenate_files(files), 10000)
+    pd.testing.assert_frame_equal(streamed, expected)
+
+
+def test_parse_read_dates():
+    """Dates not in the HDF format fall back to day first inference"""
+    dates = parse_read_dates(
+        pd.Series(["19-12-2024 00:00", "2024-12-18 00:00", "17/12/2024", None])
+    )
+
+    assert dates.iloc[0] == pd.Timestamp(2024, 12, 19)
+    assert dates.iloc[1] == pd.Timestamp(2024, 12, 18)
+    assert dates.iloc[2] == pd.Timestamp(2024, 12, 17)
+    assert pd.isna(dates.iloc[3])
+
+
+def test_concatenate_3_files_compact():
+    """Compact readings hold the meter once, and pivot the same"""
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    df = concatenate_files(files, compact=True)
+
+    assert df.shape == (3376, 3)
+    assert list(df.columns) == [READ_VALUE, READ_TYPE, "day"]
+    assert df[READ_TYPE].dtype == "category"
+    assert len(df[READ_TYPE].cat.categories) == 5
+    assert df["day"].dtype == np.int32
+    assert df.attrs[MPRN] == "01234567890"
+    assert df.attrs[METER_SERIAL_NUMBER] == "000000000087654321"
+
+    # 19-12-2024 is 20076 days after 01-01-1970
+    assert df["day"].iloc[0] == 20076
+
+    pd.testing.assert_frame_equal(
+        extract_import_entries(df, 10000),
+        extract_import_entries(concatenate_files(files), 10000),
+    )
+
+
 def test_extract_import_entries_3_file():
     """
     Load 3 files and test their pivoting in a table
@@ -253,6 +567,26 @@ def test_extract_import_entries_3_file():
     assert np.isnan(reduced_df[NIGHT_IMPORT_REGISTER, 2024].iloc[354])
 
 
+def test_extract_import_entries_pivots_match():
+    """The NumPy and pandas pivots give the same frame"""
+    df = concatenate_files(
+        [
+            "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+        ]
+    )
+    # Readings with no value or no type are left out of both
+    df.iloc[0, df.columns.get_loc(READ_VALUE)] = np.nan
+    df.iloc[1, df.columns.get_loc(READ_TYPE)] = None
+
+    for days in [10000, 1000, 30]:
+        pd.testing.assert_frame_equal(
+            extract_import_entries(df, days, pivot="numpy"),
+            extract_import_entries(df, days, pivot="pandas"),
+        )
+
+
 def test_by_month():
     """
     Load 3 files and test their pivoting in a table
@@ -394,3 +728,697 @@ def test_add_diff_columns_months():
     assert np.isnan(
         with_diff_cols[TWENTYFOUR_HR_ACTIVE_IMPORT_REGISTER + "_diff", 2022].iloc[0]
     )
+
+
+def copy_two_meters(input_dir: Path) -> Path:
+    """Copy the fixtures in to `input_dir`, and again as a second meter"""
+    input_dir.mkdir()
+    for name in [
+        "HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]:
+        text = Path("test", name).read_text()
+        (input_dir / name).write_text(text)
+        other = name.replace("01234567890", "09876543210")
+        (input_dir / other).write_text(text.replace("01234567890", "09876543210"))
+    return input_dir
+
+
+def test_run_batch(tmp_path):
+    """Two meters in one directory produce two workbooks and a summary"""
+    input_dir = copy_two_meters(tmp_path / "in")
+
+    output_dir = tmp_path / "out"
+    summary = run_batch([str(input_dir)], 10000, workers=2, output_dir=str(output_dir))
+
+    assert summary.shape[0] == 2
+    assert summary["error"].isna().all()
+    assert summary.loc[("01234567890", "000000000087654321"), "files"] == 3
+    assert summary.loc[("09876543210", "000000000087654321"), "rows"] == 3376
+    assert (output_dir / "01234567890_000000000087654321_10000_data.xlsx").exists()
+    assert (output_dir / "09876543210_000000000087654321_10000_data.xlsx").exists()
+    assert (output_dir / "batch_summary.csv").exists()
+
+    (tmp_path / "empty").mkdir()
+    empty = run_batch([str(tmp_path / "empty")], 10000, output_dir=str(output_dir))
+    assert empty.empty
+    assert empty.index.names == ["MPRN", "Meter Serial Number"]
+
+
+def test_store_incremental(tmp_path):
+    """
+    The third file adds 7 days of import/export and corrects the 18th import.
+    Only those readings change in the store, and re-ingesting does nothing.
+    """
+    conn = open_store(str(tmp_path / "readings.sqlite"))
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+    ]
+    assert ingest_files(conn, files).shape[0] == 3358
+
+    changed = ingest_files(
+        conn, files + ["test/HDF_Daily_kWh_01234567890_26-12-2024.csv"]
+    )
+    assert changed.shape[0] == 15
+    import_18th = changed[changed[READ_DATE_AND_END_TIME] == "18-12-2024 00:00"]
+    assert import_18th[READ_TYPE].tolist() == [TWENTYFOUR_HR_ACTIVE_IMPORT_REGISTER]
+    assert import_18th[READ_VALUE].tolist() == [34400.0]
+
+    assert ingest_files(conn, files).empty
+
+    # Files with only the header are skipped
+    header_only = tmp_path / "HDF_Daily_kWh_01234567890_27-12-2024.csv"
+    header_only.write_text(Path(files[1]).read_text().splitlines()[0] + "\n")
+    assert ingest_files(conn, [str(header_only)]).empty
+
+    # The 15 changed readings are 14 new ones and the corrected 18th
+    for days in [10000, 1e9]:
+        loaded = load_readings(conn, "01234567890", "000000000087654321", days)
+        assert loaded.shape[0] == 3358 + 14
+
+    stored = extract_import_entries(
+        load_readings(conn, "01234567890", "000000000087654321"), 10000
+    )
+    expected = extract_import_entries(
+        concatenate_files(files + ["test/HDF_Daily_kWh_01234567890_26-12-2024.csv"]),
+        10000,
+    )
+    pd.testing.assert_frame_equal(stored, expected)
+
+
+def add_diff_columns_reference(data, zero_to_nan: bool = True):
+    """The original column by column implementation of add_diff_columns"""
+    columns_list = list(data.columns)
+
+    # Forward-fill any empty values cells with data from last good value
+    data = data.ffill(axis=0)
+
+    for column in columns_list:
+        # Add a diff column to the dataframe
+        # This uses the pandas diff function to calculate the difference
+        # between the current and previous value in the column
+        # This does no work where the data is wrapped over from the previous
+        # year - that requires an extra function.
+        data.loc[:, (str(column[0]) + "_diff", column[1])] = data.loc[
+            :, (column[0], column[1])
+        ].diff()
+
+        try:
+            _ = columns_list.index((column[0], column[1] - 1))
+            first_index = data.index[0]
+            last_index = data.index[-1]
+            end_last_year = data.loc[last_index, (column[0], column[1] - 1)]
+            start_this_year = data.loc[first_index, (column[0], column[1])]
+            data.loc[first_index, (str(column[0]) + "_diff", column[1])] = (
+                start_this_year - end_last_year
+            )
+        except ValueError:
+            pass  # No previous year data
+
+        if zero_to_nan:
+            # Zero difference means there's no difference in a day
+            # Usually only possible for export, as everything else will
+            # change daily
+            data[str(column[0]) + "_diff", column[1]] = data[
+                str(column[0]) + "_diff", column[1]
+            ].replace(0, np.nan)
+
+    return data
+
+
+def test_add_diff_columns_matches_reference():
+    df = concatenate_files(
+        [
+            "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+        ]
+    )
+    reduced_df = extract_import_entries(df, 10000)
+
+    # The reference left no diff after a gap at the start of a year. The
+    # chronological diffs bridge it, from the last reading of 2022 (12-23).
+    with_diffs = add_diff_columns(reduced_df)
+    reference = add_diff_columns_reference(reduced_df)
+    bridged = with_diffs.notna() & reference.isna()
+    assert list(with_diffs.columns[bridged.any()]) == [
+        ("24 Hr Active Import Register (kWh)_diff", 2023),
+    ]
+    assert bridged.sum().sum() == 1
+    assert with_diffs.loc[
+        "06-09", ("24 Hr Active Import Register (kWh)_diff", 2023)
+    ] == pytest.approx(11569.276 - 4180.112)
+    pd.testing.assert_frame_equal(with_diffs.where(~bridged), reference)
+
+    month_df = by_month(reduced_df)
+    with_diffs = add_diff_columns(month_df, zero_to_nan=False)
+    reference = add_diff_columns_reference(month_df, zero_to_nan=False)
+    bridged = with_diffs.notna() & reference.isna()
+    assert bridged.sum().sum() == 1
+    assert with_diffs.loc[
+        "June", ("24 Hr Active Import Register (kWh)_diff", 2023)
+    ] == pytest.approx(12241.183 - 4180.112)
+    pd.testing.assert_frame_equal(with_diffs.where(~bridged), reference)
+
+
+def test_add_diff_columns_empty():
+    """A pivot without readings in the window is returned as it is"""
+    df = concatenate_files(["test/HDF_Daily_kWh_01234567890_20-12-2024.csv"])
+    reduced_df = extract_import_entries(df, 0)
+    assert reduced_df.shape == (0, 0)
+
+    with_diffs = add_diff_columns(reduced_df)
+    pd.testing.assert_frame_equal(with_diffs, reduced_df)
+    assert with_diffs.attrs["MPRN"] == "01234567890"
+    assert add_diff_columns(by_month(reduced_df), zero_to_nan=False).shape == (12, 0)
+
+
+def test_add_diff_columns_across_years():
+    """Diffs follow the dates across a missing year, and skip 29 February"""
+    index = pd.Index(["01-01", "02-28", "02-29", "03-01", "12-31"], name="month_day")
+    columns = pd.MultiIndex.from_product(
+        [["Night Import Register (kWh)"], [2020, 2022]], names=["Read Type", "year"]
+    )
+    data = pd.DataFrame(
+        [[1.0, 60.0], [2.0, 61.0], [3.0, np.nan], [4.0, 63.0], [np.nan, np.nan]],
+        index=index,
+        columns=columns,
+    )
+
+    diffs = add_diff_columns(data)[("Night Import Register (kWh)_diff", 2022)]
+    # From 2020's last reading, 4.0 on 03-01, as there is no 2021
+    np.testing.assert_array_equal(diffs.to_numpy(), [56.0, 1.0, np.nan, 2.0, np.nan])
+
+
+def by_month_reference(data):
+    """The original string based implementation of by_month"""
+    data["month"] = data.index.str.split("-").str[0]
+    data["month"] = data["month"].replace(
+        {f"{month:02d}": name for month, name in enumerate(month_names, start=1)}
+    )
+    return data.groupby("month").max().reindex(month_names)
+
+
+def test_by_month_matches_reference():
+    """The reduceat monthly maxima match the groupby, and leave the input alone"""
+    df = concatenate_files(
+        [
+            "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+        ]
+    )
+    reduced_df = extract_import_entries(df, 10000)
+    before = reduced_df.copy()
+
+    # The reference's month column turned the year level in to objects
+    for data in (reduced_df, reduced_df.iloc[::-1], reduced_df.iloc[200:260]):
+        pd.testing.assert_frame_equal(
+            by_month(data), by_month_reference(data.copy()), check_column_type=False
+        )
+    pd.testing.assert_frame_equal(reduced_df, before)
+    assert by_month(reduced_df).attrs == reduced_df.attrs
+
+
+def test_read_cached_csv(tmp_path):
+    """A repeat read comes from the cache, and the cache is kept to its limit"""
+    cache_dir = str(tmp_path / "cache")
+    file = "test/HDF_Daily_kWh_01234567890_20-12-2024.csv"
+
+    first = read_cached_csv(file, cache_dir)
+    assert first.shape == (1249, 5)
+    assert first[READ_TYPE].dtype == "category"
+    assert first[READ_DATE_AND_END_TIME].iloc[0] == pd.Timestamp(2024, 12, 19)
+
+    entries = list((tmp_path / "cache" / "entries").iterdir())
+    assert len(entries) == 1
+    second = read_cached_csv(file, cache_dir)
+    pd.testing.assert_frame_equal(first, second)
+
+    # With no room for more than one file the least recently used is evicted
+    read_cached_csv("test/HDF_Daily_kWh_01234567890_26-12-2024.csv", cache_dir, 0)
+    remaining = list((tmp_path / "cache" / "entries").iterdir())
+    assert len(remaining) == 1
+    assert remaining != entries
+    # The key of the evicted file goes with it
+    assert len(list((tmp_path / "cache" / "keys").iterdir())) == 1
+
+
+def test_concatenate_cached_matches(tmp_path):
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    for _ in range(2):  # Once to fill the cache, then from it
+        cached = extract_import_entries(
+            concatenate_files(files, cache_dir=str(tmp_path)), 10000
+        )
+        expected = extract_import_entries(concatenate_files(files), 10000)
+        pd.testing.assert_frame_equal(cached, expected)
+
+
+def test_write_sheets(tmp_path):
+    """Every backend writes the Daily and Monthly sheets"""
+    df = concatenate_files(
+        [
+            "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        ],
+        compact=True,
+    )
+    daily, monthly = build_sheets(df, 10000)
+    sheets = {"Daily": daily, "Monthly": monthly}
+    outfile = str(tmp_path / "out.xlsx")
+
+    for backend in ["openpyxl", "xlsxwriter", "ods"]:
+        if backend == "xlsxwriter":
+            pytest.importorskip("xlsxwriter")
+        (written,) = write_sheets(sheets, outfile, backend)
+        read = pd.read_excel(written, sheet_name="Daily", header=[0, 1], index_col=0)
+        assert read.shape == daily.shape
+        assert (
+            read[TWENTYFOUR_HR_ACTIVE_IMPORT_REGISTER, 2024].loc["12-19"] == 34458.640
+        )
+
+    written = write_sheets(sheets, outfile, "csv")
+    assert written == [
+        str(tmp_path / "out_Daily.csv"),
+        str(tmp_path / "out_Monthly.csv"),
+    ]
+    read = pd.read_csv(written[1], header=[0, 1], index_col=0)
+    assert read.index[0] == "January"
+
+    pytest.importorskip("pyarrow")
+    written = write_sheets(sheets, outfile, "parquet")
+    pd.testing.assert_frame_equal(pd.read_parquet(written[0]), daily, check_like=True)
+
+
+def test_generate_hdf_files(tmp_path):
+    """Synthetic files have the fixture layout, and later files correct earlier"""
+    files = generate_hdf_files(str(tmp_path), years=1, meters=2, gap_rate=0.1)
+    assert len(files) == 6
+    assert files[2].endswith("HDF_Daily_kWh_01234567890_26-12-2024.csv")
+
+    df = concatenate_files(files[:3])
+    assert list(df.columns) == [
+        MPRN,
+        METER_SERIAL_NUMBER,
+        READ_VALUE,
+        READ_TYPE,
+        READ_DATE_AND_END_TIME,
+    ]
+    assert df[READ_DATE_AND_END_TIME].iloc[0] == "25-12-2024 00:00"
+
+    # The newest file revises the import of the 18th and 19th upwards
+    imports = df[
+        (df[READ_TYPE] == TWENTYFOUR_HR_ACTIVE_IMPORT_REGISTER)
+        & (df[READ_DATE_AND_END_TIME] == "18-12-2024 00:00")
+    ][READ_VALUE]
+    if len(imports) == 2:  # The older reading may be a gap
+        assert imports.iloc[1] > imports.iloc[0]
+
+    stages = bench_pipeline(files, 10000, output_dir=str(tmp_path))
+    assert list(stages) == [
+        "read_csv",
+        "concatenate_files",
+        "extract_import_entries",
+        "add_diff_columns",
+        "by_month",
+        "export",
+    ]
+    assert stages["read_csv"]["rows"] == sum(read_csv(f).shape[0] for f in files)
+
+
+def test_daemon_updates_changed_meters(tmp_path):
+    """New files are merged in memory, and only changed workbooks rewritten"""
+    inbox = tmp_path / "inbox"
+    output_dir = str(tmp_path / "out")
+    inbox.mkdir()
+    names = [
+        "HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    for name in names[:2]:
+        (inbox / name).write_bytes(Path("test", name).read_bytes())
+
+    meters = watch(str(inbox), 10000, output_dir, settle=0, iterations=1)
+    key = ("01234567890", "000000000087654321")
+    workbook = os.path.join(output_dir, output_filename(*key, 10000))
+    assert os.path.exists(workbook)
+
+    (inbox / names[2]).write_bytes(Path("test", names[2]).read_bytes())
+    new_file = [str(inbox / names[2])]
+    assert update_meters(meters, new_file, 10000, output_dir) == [workbook]
+    assert update_meters(meters, new_file, 10000, output_dir) == []
+
+    expected = extract_import_entries(
+        concatenate_files([os.path.join("test", name) for name in names]), 10000
+    )
+    pd.testing.assert_frame_equal(
+        extract_import_entries(meters[key]["data"], 10000), expected
+    )
+
+    # An evicted meter is read again from its files on its next update
+    evict_idle(meters, 0)
+    assert meters[key]["data"] is None
+    assert update_meters(meters, new_file, 10000, output_dir) == [workbook]
+    pd.testing.assert_frame_equal(
+        extract_import_entries(meters[key]["data"], 10000), expected
+    )
+
+    # Files that are removed, or cut short, are logged and skipped
+    short = inbox / "HDF_Daily_kWh_09876543210_27-12-2024.csv"
+    short.write_text(
+        "MPRN,Meter Serial Number,Read Value,Read Type,Read Date and End Time\n"
+        "09876543210\n"
+    )
+    missing = str(inbox / "HDF_Daily_kWh_05555555555_27-12-2024.csv")
+    assert update_meters(meters, [str(short), missing], 10000, output_dir) == []
+
+
+def test_server_converts_uploads():
+    """Uploads are converted over HTTP, and repeat uploads served from cache"""
+    loop = asyncio.new_event_loop()
+    cache = OrderedDict()
+    with ThreadPoolExecutor(2) as executor:
+        server = loop.run_until_complete(start_server("127.0.0.1", 0, executor, cache))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        url = "http://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+
+        files = [
+            "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        ]
+        try:
+            with requests.Session() as session:
+                assert session.get(f"{url}/health").text == "ok"
+
+                response = session.post(
+                    f"{url}/convert?days=10000&format=json",
+                    files=[("file", Path(file).read_bytes()) for file in files],
+                )
+                assert response.status_code == 200
+                result = response.json()
+                assert result["MPRN"] == "01234567890"
+
+                daily, _ = build_sheets(concatenate_files(files), 10000)
+                assert result["Daily"]["index"] == list(daily.index)
+                np.testing.assert_allclose(
+                    np.array(result["Daily"]["data"], dtype=float), daily.to_numpy()
+                )
+
+                # The same files in another order are served from the cache
+                response = session.post(
+                    f"{url}/convert?days=10000&format=json",
+                    files=[("file", Path(file).read_bytes()) for file in files[::-1]],
+                )
+                assert response.json() == result
+                assert len(cache) == 1
+
+                response = session.post(
+                    f"{url}/convert?days=10000", data=Path(files[1]).read_bytes()
+                )
+                assert response.status_code == 200
+                assert response.content[:2] == b"PK"
+                assert "_10000_data.xlsx" in response.headers["Content-Disposition"]
+
+                assert session.post(f"{url}/convert", data=b"").status_code == 400
+                # Files older than the window give empty sheets
+                response = session.post(
+                    f"{url}/convert?days=0&format=json",
+                    data=Path(files[1]).read_bytes(),
+                )
+                assert response.status_code == 200
+                assert response.json()["Daily"]["data"] == []
+                assert session.post(f"{url}/convert", data=b"x,y").status_code == 400
+                assert session.get(f"{url}/other").status_code == 404
+
+            # A Content-Length that is not a length is refused
+            for length in [b"abc", b"-1"]:
+                address = server.sockets[0].getsockname()
+                with socket.create_connection(address) as connection:
+                    connection.sendall(
+                        b"POST /convert HTTP/1.1\r\nContent-Length: %s\r\n\r\n" % length
+                    )
+                    assert connection.recv(1024).startswith(b"HTTP/1.1 400")
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+
+
+def test_submit_rows(tmp_path):
+    """Days are posted in batches, retried, and not sent twice"""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            # Fail the first post, to be retried
+            status = 503 if not received else 200
+            received.append(json.loads(body) if status == 200 else None)
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.start()
+    url = "http://127.0.0.1:%d/hook" % httpd.server_address[1]
+    ledger = str(tmp_path / "ledger.sqlite")
+
+    try:
+        df = concatenate_files(["test/HDF_Daily_kWh_01234567890_26-12-2024.csv"])
+        rows = daily_rows(extract_import_entries(df, 10000))
+        assert len(rows) == 9
+        assert rows[-1] == {
+            "MPRN": "01234567890",
+            "Meter Serial Number": "000000000087654321",
+            "date": "2024-12-26",
+            "24 Hr Active Export Register (kWh)": 5450.509,
+            "24 Hr Active Import Register (kWh)": 34640.64,
+        }
+
+        with make_session(workers=2, backoff=0) as session:
+            options = {"batch_size": 4, "workers": 2, "session": session}
+            assert submit_rows(rows, url, ledger, **options) == 9
+            posted = [row for batch in received if batch for row in batch]
+            assert sorted(posted, key=lambda row: row["date"]) == rows
+            assert max(len(batch) for batch in received if batch) == 4
+
+            # Only new or corrected days are sent again
+            assert submit_rows(rows, url, ledger, **options) == 0
+            rows[0]["24 Hr Active Export Register (kWh)"] += 1
+            assert submit_rows(rows, url, ledger, **options) == 1
+
+        # Form posts are not retried once sent, as the form may have taken them
+        with make_session(idempotent=False) as session:
+            retry = session.get_adapter(url).max_retries
+            assert retry.read == 0 and 500 not in retry.status_forcelist
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+
+def import_ms(args: list[str]) -> tuple[float, set[str]]:
+    """
+    The time in ms of the top level imports of running Python with `args`,
+    from -X importtime, and the names of all the modules imported
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines of "import time: self | cumulative | name", nested by indent
+    total = 0.0
+    names = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            _, cumulative, name = line.split("|")
+            names.add(name.strip())
+            if not name.startswith("  "):
+                total += int(cumulative) / 1000
+    return total, names
+
+
+def test_latest_without_pandas():
+    """
+    The --latest query starts and runs without importing pandas or numpy, so
+    it starts in well under the time to import pandas
+    """
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "main.py", "7", *files, "--latest"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert "24 Hr Active Import Register (kWh): 34640.64 at 26-12-2024 00:00" in (
+        result.stdout
+    )
+
+    startup, names = import_ms(["main.py", "7", *files, "--latest"])
+    assert "pandas" not in names and "numpy" not in names
+
+    # Timed against the interpreter's own imports, and pandas, on this machine
+    interpreter, _ = import_ms(["-c", "pass"])
+    with_pandas, _ = import_ms(["-c", "import pandas"])
+    assert startup - interpreter < (with_pandas - interpreter) / 2
+
+    df = concatenate_files(files)
+    df["date"] = parse_read_dates(df[READ_DATE_AND_END_TIME])
+    expected = df.sort_values(["date", READ_VALUE]).groupby(READ_TYPE).last()
+    latest = latest_readings(files)
+    assert sorted(latest) == sorted(expected.index)
+    for read_type, (date, value) in latest.items():
+        assert (date, value) == tuple(expected.loc[read_type, ["date", READ_VALUE]])
+
+
+def test_validate_readings(tmp_path):
+    """The fixtures have conflicts, gaps and a sum error, and no decreases"""
+    data = concatenate_files(
+        [
+            "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+            "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+        ],
+        compact=True,
+    )
+    report = validate_readings(data)
+    counts = report["check"].value_counts()
+    assert counts.to_dict() == {"gap": 74, "conflict": 2, "sum": 1}
+
+    error = report[report["severity"] == "error"].iloc[0]
+    assert error["check"] == "sum"
+    assert error["start"] == pd.Timestamp("2024-12-18")
+    assert error["value"] == pytest.approx(16.942)
+
+    # A register lower than the day before
+    read_types = data[READ_TYPE].astype(str)
+    last = data[read_types == NIGHT_IMPORT_REGISTER]["day"].idxmax()
+    data.loc[last, READ_VALUE] = 0.0
+    decreases = validate_readings(data).query("check == 'decrease'")
+    assert decreases[READ_TYPE].tolist() == [NIGHT_IMPORT_REGISTER]
+
+    report_file = tmp_path / "anomalies.csv"
+    with pytest.raises(ValueError, match="errors"):
+        check_readings(data, fail_fast=True, report_file=str(report_file))
+    # The decrease, and the sum it breaks on the same day
+    assert len(pd.read_csv(report_file)) == len(report) + 2
+
+
+def test_archive_round_trip(tmp_path):
+    """Readings archived file by file load back to the same sheets"""
+    pytest.importorskip("pyarrow")
+    from archive import append_archive, load_archive
+
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    path = str(tmp_path / "archive")
+    for file in files:
+        append_archive(path, concatenate_files([file], compact=True))
+
+    partitions = sorted(p.name for p in (tmp_path / "archive").glob("MPRN=*/*"))
+    assert partitions == ["year=2022", "year=2023", "year=2024"]
+
+    archived = load_archive(path, "01234567890")
+    assert archived.attrs["Meter Serial Number"] == "000000000087654321"
+    pd.testing.assert_frame_equal(
+        extract_import_entries(archived, 10000),
+        extract_import_entries(concatenate_files(files, compact=True), 10000),
+    )
+
+    november = load_archive(
+        path, "01234567890", start=datetime(2024, 11, 1), end=datetime(2024, 11, 30)
+    )
+    days = november["day"].to_numpy().astype("datetime64[D]")
+    assert days.min() == np.datetime64("2024-11-01")
+    assert days.max() == np.datetime64("2024-11-30")
+
+
+def test_sketch_quantiles_merge():
+    """Merged sketches estimate percentiles within their accuracy"""
+    values = np.random.default_rng(0).lognormal(5, 1, 10000)
+    sketch = Counter(sketch_buckets(values[:5000]).tolist())
+    sketch.update(Counter(sketch_buckets(values[5000:]).tolist()))
+    for q in [0.1, 0.5, 0.9]:
+        assert sketch_quantile(sketch, q) == pytest.approx(
+            np.quantile(values, q), rel=0.02
+        )
+    assert sketch_quantile(Counter(sketch_buckets([0.0, -1.0]).tolist()), 0.5) == 0
+
+
+def test_fleet_report(tmp_path):
+    """Two identical meters sum to twice one meter, with the same percentiles"""
+    input_dir = copy_two_meters(tmp_path / "in")
+
+    outfile = tmp_path / "fleet.xlsx"
+    summary = fleet_report([str(input_dir)], 10000, workers=1, outfile=str(outfile))
+    one = meter_aggregates(sorted(input_dir.glob("*01234567890*")), 10000)
+
+    assert (summary["meters"] == 2).all()
+    key = (TWENTYFOUR_HR_ACTIVE_IMPORT_REGISTER, 2024, 6)
+    assert summary.loc[key, "total_kWh"] == pytest.approx(2 * one[key]["sum"])
+    assert summary.loc[key, "p50_kWh"] == pytest.approx(one[key]["sum"], rel=0.01)
+
+    sheets = pd.read_excel(outfile, sheet_name=None)
+    assert list(sheets) == ["Monthly", "Year on year"]
+
+
+def test_scan_csv(tmp_path):
+    """The scanner reads the fixtures as pandas does, and falls back to it"""
+    files = [
+        "test/HDF_DailyDNP_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_20-12-2024.csv",
+        "test/HDF_Daily_kWh_01234567890_26-12-2024.csv",
+    ]
+    for file in files:
+        scanned = scan_csv(file)
+        expected = compact_readings(read_csv(file))
+        pd.testing.assert_frame_equal(scanned, expected, check_exact=True)
+        assert scanned.attrs == expected.attrs
+
+    pd.testing.assert_frame_equal(
+        concatenate_files(files, scan=True), concatenate_files(files, compact=True)
+    )
+
+    # Interval files are left in the HDF layout to be resampled
+    interval = scan_csv("test/interval/HDF_kW_01234567890_20-12-2024.csv")
+    assert interval.shape == (288, 5)
+
+    # Quoted fields are read by pandas
+    quoted = tmp_path / "quoted.csv"
+    text = Path("test/HDF_Daily_kWh_01234567890_26-12-2024.csv").read_text()
+    quoted.write_text(text.replace("000000000087654321", '"000000000087654321"'))
+    pd.testing.assert_frame_equal(
+        scan_csv(str(quoted)),
+        compact_readings(read_csv("test/HDF_Daily_kWh_01234567890_26-12-2024.csv")),
+    )
+
+    # As are files that are not UTF-8
+    malformed = tmp_path / "malformed.csv"
+    content = Path("test/HDF_Daily_kWh_01234567890_26-12-2024.csv").read_bytes()
+    malformed.write_bytes(content.replace(b"Night", b"Nu\xe9t"))
+    pd.testing.assert_frame_equal(
+        scan_csv(str(malformed)), compact_readings(read_csv(str(malformed)))
+    )
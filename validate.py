@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+from loguru import logger
+from pandas import DataFrame
+
+from main import compact_readings
+
+# Registers whose sum should be the 24 Hr import register, within rounding
+# of their three decimal places
+import_parts = [
+    "Day Off-Peak Import Register (kWh)",
+    "Day Peak Import Register (kWh)",
+    "Night Import Register (kWh)",
+]
+import_total = "24 Hr Active Import Register (kWh)"
+SUM_TOLERANCE_KWH = 0.01
+
+# Decreasing counters and registers that do not add up are errors. Gaps and
+# conflicting readings, which later downloads fill or correct, are warnings.
+severities = {
+    "decrease": "error",
+    "sum": "error",
+    "conflict": "warning",
+    "gap": "warning",
+}
+
+report_columns = ["check", "severity", "Read Type", "start", "end", "value"]
+
+
+def anomalies(check, read_types, start, end, value) -> DataFrame:
+    """Rows of the anomaly report for one check, from arrays of days"""
+    return DataFrame(
+        {
+            "check": check,
+            "severity": severities[check],
+            "Read Type": np.asarray(read_types, dtype=object),
+            "start": np.asarray(start).astype("datetime64[D]"),
+            "end": np.asarray(end).astype("datetime64[D]"),
+            "value": np.asarray(value, dtype=float),
+        },
+        columns=report_columns,
+    )
+
+
+def validate_readings(
+    data: DataFrame, tolerance: float = SUM_TOLERANCE_KWH
+) -> DataFrame:
+    """
+    Check concatenated readings, in the HDF layout or compact, for:
+
+    * conflict - readings of the same Read Type and day that differ between
+      files (value: the spread)
+    * decrease - a cumulative register lower than the day before (value:
+      the drop)
+    * gap - days missing between a register's first and last readings
+      (value: the days missing)
+    * sum - the 24 Hr import register not equal to the sum of the Day,
+      Peak and Night registers (value: the difference)
+
+    The readings are sorted once by Read Type and day, and every check is
+    vectorised over the sorted arrays.
+
+    :return: one row per anomaly, with the days it spans
+    """
+    data = compact_readings(data)
+    data = data[data["Read Value"].notna()]
+    categories = data["Read Type"].cat.categories
+    codes = data["Read Type"].cat.codes.to_numpy().astype(np.int64)
+    days = data["day"].to_numpy().astype(np.int64)
+    values = data["Read Value"].to_numpy()
+
+    report = [DataFrame(columns=report_columns)]
+    if len(values) == 0:
+        return report[0]
+
+    first_day = days.min()
+    span = days.max() - first_day + 1
+    order = np.argsort(codes * span + (days - first_day), kind="stable")
+    codes, days, values = codes[order], days[order], values[order]
+
+    # One entry per Read Type and day, with the spread of its readings
+    starts = np.flatnonzero(
+        np.r_[True, (codes[1:] != codes[:-1]) | (days[1:] != days[:-1])]
+    )
+    highest = np.maximum.reduceat(values, starts)
+    spread = highest - np.minimum.reduceat(values, starts)
+    codes, days = codes[starts], days[starts]
+
+    conflicts = spread > 0
+    report.append(
+        anomalies(
+            "conflict",
+            categories[codes[conflicts]],
+            days[conflicts],
+            days[conflicts],
+            spread[conflicts],
+        )
+    )
+
+    # Consecutive days of the same Read Type
+    same_type = codes[1:] == codes[:-1]
+    drops = same_type & (highest[1:] < highest[:-1])
+    report.append(
+        anomalies(
+            "decrease",
+            categories[codes[1:][drops]],
+            days[:-1][drops],
+            days[1:][drops],
+            (highest[:-1] - highest[1:])[drops],
+        )
+    )
+
+    missing = days[1:] - days[:-1] - 1
+    gaps = same_type & (missing > 0)
+    report.append(
+        anomalies(
+            "gap",
+            categories[codes[1:][gaps]],
+            days[:-1][gaps] + 1,
+            days[1:][gaps] - 1,
+            missing[gaps],
+        )
+    )
+
+    # The registers of every day as a dense day x register matrix
+    registers = [import_total] + import_parts
+    if all(register in categories for register in registers):
+        matrix = np.full((span, len(registers)), np.nan)
+        for column, register in enumerate(registers):
+            rows = codes == categories.get_loc(register)
+            matrix[days[rows] - first_day, column] = highest[rows]
+        difference = matrix[:, 0] - matrix[:, 1:].sum(axis=1)
+        wrong = np.flatnonzero(np.abs(difference) > tolerance)
+        report.append(
+            anomalies(
+                "sum",
+                [import_total] * len(wrong),
+                wrong + first_day,
+                wrong + first_day,
+                difference[wrong],
+            )
+        )
+
+    report = pd.concat([part for part in report if len(part)] or report[:1])
+    return report.sort_values(["check", "Read Type", "start"], ignore_index=True)
+
+
+def log_anomalies(report: DataFrame):
+    if report.empty:
+        logger.info("Validation found no anomalies")
+        return
+    for (check, severity), rows in report.groupby(["check", "severity"]):
+        first = rows.iloc[0]
+        logger.log(
+            "ERROR" if severity == "error" else "WARNING",
+            f"{len(rows)} {check} anomalies, first {first['Read Type']} "
+            f"{first['start']:%d-%m-%Y} to {first['end']:%d-%m-%Y}: {first['value']:g}",
+        )
+
+
+def check_readings(
+    data: DataFrame, fail_fast: bool = False, report_file: str = None
+) -> DataFrame:
+    """
+    Validate the readings and log a summary of the anomalies, writing them
+    to `report_file` if there are any. With `fail_fast` any error raises a
+    ValueError, so no spreadsheet is written from bad readings.
+    """
+    report = validate_readings(data)
+    log_anomalies(report)
+
+    if report_file is not None and not report.empty:
+        report.to_csv(report_file, index=False)
+        logger.info(f"Wrote {len(report)} anomalies to {report_file}")
+
+    errors = (report["severity"] == "error").sum()
+    if fail_fast and errors:
+        raise ValueError(f"Validation found {errors} errors in the readings")
+    return report